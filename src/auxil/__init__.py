@@ -1 +1 @@
-__all__ = ["auxil","congrid","header","png","polsar","supervisedclass"]
\ No newline at end of file
+__all__ = ["auxil","congrid","header","png","polsar","supervisedclass","training"]
\ No newline at end of file
@@ -17,15 +17,21 @@
 #    GNU General Public License for more details.
 
 import numpy as np  
-import math, platform, StringIO
+import math, os, platform, tempfile, threading, StringIO
 from . import png   
 # comment out for GAE deployment---------
 from numpy.ctypeslib import ndpointer
 import Tkinter,tkFileDialog,tkSimpleDialog,tkMessageBox 
 import ctypes
+from multiprocessing.pool import ThreadPool
 from scipy.special import betainc 
+from scipy import linalg
 from numpy.fft import fft2, ifft2, fftshift 
 import scipy.ndimage.interpolation as ndii 
+try:
+    import numexpr as ne
+except ImportError:
+    ne = None
 if platform.system() == 'Windows': 
     lib = ctypes.cdll.LoadLibrary('prov_means.dll')
 elif platform.system() == 'Linux':
@@ -101,6 +107,27 @@ def orthoregress(x,y):
     b = vs[1,1]/vs[0,1] # first pc is second column
     return [b,Ym-b*Xm,R]
 
+def orthoregress_many(X,Y):
+    '''orthogonal regression of the columns of Y on
+       those of X, returns arrays of slopes, intercepts
+       and correlations, one entry per column'''
+    X = np.asarray(X,dtype=np.float64)
+    Y = np.asarray(Y,dtype=np.float64)
+    Xm = np.mean(X,axis=0)
+    Ym = np.mean(Y,axis=0)
+    dX = X - Xm
+    dY = Y - Ym
+    sxx = np.einsum('ij,ij->j',dX,dX)
+    syy = np.einsum('ij,ij->j',dY,dY)
+    sxy = np.einsum('ij,ij->j',dX,dY)
+    R = sxy/np.sqrt(sxx*syy)
+#  slope of the principal eigenvector of the 2x2 covariance matrix
+    d = syy - sxx
+    with np.errstate(divide='ignore',invalid='ignore'):
+        b = (d + np.sqrt(d*d + 4*sxy*sxy))/(2*sxy)
+    b = np.where(sxy==0,np.where(d>0,np.inf,0.0),b)
+    return [b,Ym-b*Xm,R]
+
 # -------------------------
 # F-test for equal variance
 # -------------------------
@@ -161,6 +188,9 @@ class Cpm(object):
         n,N = np.shape(Xs)       
         if Ws is None:
             Ws = np.ones(n)
+#      the C routine requires contiguous float64 arrays            
+        Xs = np.ascontiguousarray(Xs,np.float64)
+        Ws = np.ascontiguousarray(Ws,np.float64)
         sw = ctypes.c_double(self.sw)        
         mn = self.mn
         cov = self.cov
@@ -175,7 +205,299 @@ class Cpm(object):
         return c + c.T - d
     
     def means(self):
-        return self.mn            
+        return self.mn
+
+    def merge(self,other):
+#      pairwise (Chan et al.) combination with another 
+#      accumulator, as if its data had been added by update()
+        sw = self.sw + other.sw
+        d = other.mn - self.mn
+        self.mn = self.mn + d*(other.sw/sw)
+        self.cov = self.cov + other.cov \
+                 + np.triu(np.outer(d,d))*(self.sw*other.sw/sw)
+        self.sw = sw
+
+# ----------------------
+# block-wise tile reader
+# ----------------------
+
+def blockrows(rasterBand,cols,pixels=2**18):
+# rows per tile: a multiple of the natural block height
+# holding roughly the given number of pixels
+    ysize = max(rasterBand.GetBlockSize()[1],1)
+    return max(pixels//(cols*ysize),1)*ysize
+
+def rowstrips(rows,nrows,n):
+# at most n contiguous (start,stop) row ranges 
+# aligned to tiles of nrows rows, or to single rows
+# if there are fewer than n tiles
+    tiles = (rows+nrows-1)//nrows
+    if tiles < n:
+        nrows = 1
+        tiles = rows
+    bounds = [min((i*tiles//n)*nrows,rows) for i in range(n+1)]
+    bounds[n] = rows
+    return [(bounds[i],bounds[i+1]) for i in range(n) \
+                                    if bounds[i] < bounds[i+1]]
+
+def stratified(nrows,cols,fraction,cell=16):
+# flat indices of a spatially stratified random subsample
+# of an nrows by cols tile, drawing about fraction*cell**2
+# pixels (with replacement) from each cell by cell square
+    k = max(int(round(fraction*cell*cell)),1)
+    r0,c0 = np.meshgrid(np.arange(0,nrows,cell),
+                        np.arange(0,cols,cell),indexing='ij')
+    h = np.minimum(cell,nrows-r0)[:,:,np.newaxis]
+    w = np.minimum(cell,cols-c0)[:,:,np.newaxis]
+    r = r0[:,:,np.newaxis] + (np.random.random(r0.shape+(k,))*h).astype(int)
+    c = c0[:,:,np.newaxis] + (np.random.random(c0.shape+(k,))*w).astype(int)
+    return np.unique(r*cols+c)
+
+class BlockReader(object):
+    '''Multi-row, all-band tile reader for one or more images.
+       rasterBands is a list of GDAL bands and offsets a list
+       of the corresponding upper left (x,y) pixel positions.
+       Iterating yields (row,nrows,tile) where tile is a
+       (nrows*cols,len(rasterBands)) float64 array'''
+    def __init__(self,rasterBands,offsets,cols,rows,nrows=None):
+        self.rasterBands = rasterBands
+        self.offsets = offsets
+        self.cols = cols
+        self.rows = rows
+        self.bands = len(rasterBands)
+        if nrows is None:
+            nrows = blockrows(rasterBands[0],cols)
+        self.nrows = max(min(nrows,rows),1)
+
+    def blocks(self,start=0,stop=None):
+#      tiles of rows start to stop
+        if stop is None:
+            stop = self.rows
+        for row in range(start,stop,self.nrows):
+            nrows = min(self.nrows,stop-row)
+            yield (row,nrows,self.read(row,nrows))
+
+    def read(self,row,nrows):
+        tile = np.empty((nrows*self.cols,self.bands))
+        for k in range(self.bands):
+            x,y = self.offsets[k]
+            tile[:,k] = self.rasterBands[k] \
+                 .ReadAsArray(x,y+row,self.cols,nrows).ravel()
+        return tile
+
+    def __iter__(self):
+        return self.blocks()
+
+class BlockCache(object):
+    '''Tiles of a BlockReader decoded once into a contiguous
+       float64 array, held in memory if it fits into budget
+       bytes, otherwise spilled to a memory-mapped scratch file
+       in directory scratch. Iterates like the reader'''
+    def __init__(self,reader,budget=2**30,scratch=None):
+        self.cols = reader.cols
+        self.rows = reader.rows
+        self.bands = reader.bands
+        self.nrows = reader.nrows
+        shape = (self.rows*self.cols,self.bands)
+        self.scratch = None
+        if shape[0]*shape[1]*8 <= budget:
+            self.data = np.empty(shape)
+        else:
+            fd, self.scratch = tempfile.mkstemp(suffix='.tiles',dir=scratch)
+            os.close(fd)
+            self.data = np.memmap(self.scratch,dtype=np.float64,
+                                  mode='w+',shape=shape)
+        try:
+            for row,nrows,tile in reader:
+                self.data[row*self.cols:(row+nrows)*self.cols,:] = tile
+        except:
+            self.close()
+            raise
+
+    def blocks(self,start=0,stop=None):
+#      tiles of rows start to stop
+        if stop is None:
+            stop = self.rows
+        for row in range(start,stop,self.nrows):
+            nrows = min(self.nrows,stop-row)
+            yield (row,nrows,
+                   self.data[row*self.cols:(row+nrows)*self.cols,:])
+
+    def __iter__(self):
+        return self.blocks()
+
+    def close(self):
+#      release the array and remove any scratch file
+        self.data = None
+        if self.scratch is not None:
+            os.remove(self.scratch)
+            self.scratch = None
+
+# -----------------
+# reservoir sampling
+# -----------------
+
+class Reservoir(object):
+    '''Uniform random sample of at most size items from a
+       stream of arrays (Algorithm R, vectorized per array)'''
+    def __init__(self,size):
+        self.size = size
+        self.items = np.zeros(size,dtype=np.int64)
+        self.count = 0
+
+    def update(self,items):
+        n = len(items)
+#      fill the reservoir first        
+        m = min(max(self.size-self.count,0),n)
+        self.items[self.count:self.count+m] = items[:m]
+        rest = np.asarray(items[m:])
+        if len(rest) > 0:
+#          item i of the stream replaces slot j, uniform on [0,i], 
+#          if j < size. The last of several replacements wins
+            i = self.count + m + np.arange(len(rest))
+            j = (np.random.random(len(rest))*(i+1)).astype(np.int64)
+            keep = np.where(j < self.size)[0]
+            j = j[keep][::-1]
+            rest = rest[keep][::-1]
+            j,first = np.unique(j,return_index=True)
+            self.items[j] = rest[first]
+        self.count += n
+
+    def sample(self):
+        return self.items[:min(self.count,self.size)]
+
+# ---------------------------------
+# fixed point iteration acceleration
+# ---------------------------------
+
+def extrapolate(x0,x1,x2):
+# squared Aitken (SQUAREM) extrapolation of three successive
+# iterates x1 = F(x0), x2 = F(x1) of a fixed point map F 
+    r = x1 - x0
+    v = x2 - 2*x1 + x0
+    nv = np.sqrt(np.sum(v*v))
+    if nv == 0.0:
+        return x2
+    alpha = min(-np.sqrt(np.sum(r*r))/nv,-1.0)
+    return x0 - 2*alpha*r + alpha**2*v
+
+# ----------------------
+# block-wise tile writer
+# ----------------------
+
+def createoptions(driver,tiled=True,compress='DEFLATE'):
+# creation options for tiled and/or compressed GeoTIFF 
+# output, other formats get no options
+    options = []
+    if driver.ShortName == 'GTiff':
+        if tiled:
+            options += ['TILED=YES','BLOCKXSIZE=256','BLOCKYSIZE=256']
+        if compress:
+            options += ['COMPRESS=%s'%compress]
+    return options
+
+class BlockWriter(object):
+    '''Buffered writer for all bands of a GDAL dataset. Tiles
+       of successive rows are written as (nrows*cols,bands) 
+       arrays and accumulated until the buffer of nrows rows 
+       is full, which is then flushed with one WriteArray call
+       per band'''
+    def __init__(self,dataset,nrows=None,dtype=np.float32):
+        self.cols = dataset.RasterXSize
+        self.bands = dataset.RasterCount
+        self.rasterBands = [dataset.GetRasterBand(k+1) 
+                            for k in range(self.bands)]
+        if nrows is None:
+            nrows = blockrows(self.rasterBands[0],self.cols)
+        self.nrows = max(min(nrows,dataset.RasterYSize),1)
+        self.buffer = np.zeros((self.bands,self.nrows,self.cols),dtype)
+        self.row = 0
+        self.filled = 0
+
+    def write(self,tile):
+#      append the rows of a tile to the buffer        
+        n = tile.shape[0]//self.cols
+        i = 0
+        while i < n:
+            m = min(n-i,self.nrows-self.filled)
+            self.buffer[:,self.filled:self.filled+m,:] = \
+                np.reshape(tile[i*self.cols:(i+m)*self.cols,:].T,
+                           (self.bands,m,self.cols))
+            self.filled += m
+            i += m
+            if self.filled == self.nrows:
+                self.flush()
+
+    def flush(self):
+        if self.filled > 0:
+            for k in range(self.bands):
+                self.rasterBands[k].WriteArray(
+                          self.buffer[k,:self.filled,:],0,self.row)
+            self.row += self.filled
+            self.filled = 0
+
+    def close(self):
+        self.flush()
+        for rasterBand in self.rasterBands:
+            rasterBand.FlushCache()
+        self.rasterBands = []
+
+def imapordered(func,items,workers=4,ahead=2):
+    '''Generator of func(item) for the items, computed in a pool
+       of workers threads and returned in the order of the items.
+       At most ahead items per thread are taken from items before
+       their results are consumed. Callers that do not exhaust the
+       results should close() the generator to release the pool'''
+    workers = max(workers,1)
+    free = threading.Semaphore(ahead*workers)
+    stop = []
+    def bounded():
+#      items are taken in the pool's task handler thread        
+        for item in items:
+            free.acquire()
+            if stop:
+                return
+            yield item
+    pool = ThreadPool(workers)
+    try:
+        for result in pool.imap(func,bounded()):
+            yield result
+            free.release()
+    finally:
+#      unblock the task handler and let it finish        
+        stop.append(True)
+        free.release()
+        pool.close()
+        pool.join()
+
+# ------------------
+# MAD transformation
+# ------------------
+
+def madtransform(tile,A,B,means1,means2,sigMADs,mads=None,chisqr=None):
+# MAD variates and chi-square values of an (n,2*bands) tile with
+# a single matrix product [X1,X2]*[A;-B] minus a constant offset. 
+# Results go into the (n,bands) and (n,) float64 arrays mads 
+# and chisqr, which are allocated if not given. Uses numexpr 
+# for the chi-square reduction when available
+    A = np.asarray(A,np.float64)
+    B = np.asarray(B,np.float64)
+    bands = A.shape[1]
+    n = tile.shape[0]
+    W = np.vstack((A,-B))
+    c = np.dot(means1,A) - np.dot(means2,B)
+    isig2 = 1.0/np.asarray(sigMADs,np.float64)**2
+    if mads is None:
+        mads = np.empty((n,bands))
+    if chisqr is None:
+        chisqr = np.empty(n)
+    np.dot(tile[:,:2*bands],W,out=mads)
+    mads -= c
+    if ne is not None:
+        ne.evaluate('sum(mads*mads*isig2,axis=1)',out=chisqr)
+    else:
+        np.einsum('ij,ij,j->i',mads,mads,isig2,out=chisqr)
+    return (mads,chisqr)
 
 # --------------------------
 # data array (design matrix)
@@ -538,29 +860,28 @@ def select_float(L,msg='Enter a number'):
 # ------------------------   
     
 def choldc(A):
-# Cholesky-Banachiewicz algorithm, 
-# A is a numpy matrix
-    L = A - A  
-    for i in range(len(L)):
-        for j in range(i):
-            sm = 0.0
-            for k in range(j):
-                sm += L[i,k]*L[j,k]
-            L[i,j] = (A[i,j]-sm)/L[j,j]
-        sm = 0.0
-        for k in range(i):
-            sm += L[i,k]*L[i,k]
-        L[i,i] = math.sqrt(A[i,i]-sm)        
-    return L               
+# Cholesky factor L of the symmetric positive definite 
+# numpy matrix A = L*L.T (LAPACK)
+    return np.mat(np.linalg.cholesky(A))
         
 def geneiv(A,B): 
-# solves A*x = lambda*B*x for numpy matrices A and B, 
-# returns eigenvectors in columns
-    Li = np.linalg.inv(choldc(B))
-    C = Li*A*(Li.transpose())
-    C = np.asmatrix((C + C.transpose())*0.5,np.float32)
-    eivs,V = np.linalg.eig(C)
-    return eivs, Li.transpose()*V     
+# solves A*x = lambda*B*x for symmetric A and symmetric 
+# positive definite B, returns the real eigenvalues in 
+# increasing order and the B-normalized eigenvectors in 
+# columns, all float64. For numpy matrices A and B the 
+# eigenvectors are a numpy matrix. For stacks A and B of 
+# shape (n,N,N) the n problems are solved together and
+# the results are stacked the same way
+    A = np.asarray(A,np.float64)
+    B = np.asarray(B,np.float64)
+    if A.ndim == 2:
+        eivs,V = linalg.eigh(A,B)
+        return eivs, np.mat(V)
+#  batch: reduce to standard form with Cholesky factors    
+    Li = np.linalg.inv(np.linalg.cholesky(B))
+    C = np.einsum('kij,kjl,kml->kim',Li,A,Li)
+    eivs,V = np.linalg.eigh((C + np.swapaxes(C,1,2))*0.5)
+    return eivs, np.einsum('kji,kjl->kil',Li,V)     
 
 # ------------------------------------------------
 # spectral transformations, use DataArray objects,
@@ -611,9 +932,49 @@ def mnf(da,samples,lines,bands):
     except:
         return None            
     
-def similarity(bn0, bn1):
+# Fourier helpers for similarity, also from Imreg.py
+
+def highpass(shape):
+    """Return highpass filter to be multiplied with fourier transform."""
+    x = np.outer(
+                    np.cos(np.linspace(-math.pi/2., math.pi/2., shape[0])),
+                    np.cos(np.linspace(-math.pi/2., math.pi/2., shape[1])))
+    return (1.0 - x) * (2.0 - x)    
+
+def logpolar(image, angles=None, radii=None):
+    """Return log-polar transformed image and log base."""
+    shape = image.shape
+    center = shape[0] / 2, shape[1] / 2
+    if angles is None:
+        angles = shape[0]
+        if radii is None:
+            radii = shape[1]
+    theta = np.empty((angles, radii), dtype=np.float64)
+    theta.T[:] = -np.linspace(0, np.pi, angles, endpoint=False)
+#      d = radii
+    d = np.hypot(shape[0]-center[0], shape[1]-center[1])
+    log_base = 10.0 ** (math.log10(d) / (radii))
+    radius = np.empty_like(theta)
+    radius[:] = np.power(log_base, np.arange(radii,
+                                               dtype=np.float64)) - 1.0
+    x = radius * np.sin(theta) + center[0]
+    y = radius * np.cos(theta) + center[1]
+    output = np.empty_like(x)
+    ndii.map_coordinates(image, [x, y], output=output)
+    return output, log_base
+
+def similarityref(bn0):
+    '''Fourier spectra of reference band bn0 used by similarity,
+       computed once when registering many bands to one reference'''
+    f0 = fftshift(abs(fft2(bn0)))
+    f0 *= highpass(f0.shape)
+    f0, log_base = logpolar(f0)
+    return (bn0, fft2(bn0), fft2(f0), log_base)
+
+def similarity(bn0, bn1, ref=None):
     """Register bn1 to bn0 ,  M. Canty 2012
 bn0, bn1 and returned result are image bands      
+ref is an optional precomputed similarityref(bn0)
 Modified from Imreg.py, see http://www.lfd.uci.edu/~gohlke/:
  Copyright (c) 2011-2012, Christoph Gohlke
  Copyright (c) 2011-2012, The Regents of the University of California
@@ -621,48 +982,16 @@ Modified from Imreg.py, see http://www.lfd.uci.edu/~gohlke/:
  All rights reserved.    
     """
  
-    def highpass(shape):
-        """Return highpass filter to be multiplied with fourier transform."""
-        x = np.outer(
-                        np.cos(np.linspace(-math.pi/2., math.pi/2., shape[0])),
-                        np.cos(np.linspace(-math.pi/2., math.pi/2., shape[1])))
-        return (1.0 - x) * (2.0 - x)    
-
-    def logpolar(image, angles=None, radii=None):
-        """Return log-polar transformed image and log base."""
-        shape = image.shape
-        center = shape[0] / 2, shape[1] / 2
-        if angles is None:
-            angles = shape[0]
-            if radii is None:
-                radii = shape[1]
-        theta = np.empty((angles, radii), dtype=np.float64)
-        theta.T[:] = -np.linspace(0, np.pi, angles, endpoint=False)
-#      d = radii
-        d = np.hypot(shape[0]-center[0], shape[1]-center[1])
-        log_base = 10.0 ** (math.log10(d) / (radii))
-        radius = np.empty_like(theta)
-        radius[:] = np.power(log_base, np.arange(radii,
-                                                   dtype=np.float64)) - 1.0
-        x = radius * np.sin(theta) + center[0]
-        y = radius * np.cos(theta) + center[1]
-        output = np.empty_like(x)
-        ndii.map_coordinates(image, [x, y], output=output)
-        return output, log_base
-             
+    if ref is None:
+        ref = similarityref(bn0)
+    bn0, F0, f0, log_base = ref
     lines0,samples0 = bn0.shape
 #  make reference and warp bands same shape    
     bn1 = bn1[0:lines0,0:samples0]   
 #  get scale, angle      
-    f0 = fftshift(abs(fft2(bn0)))
     f1 = fftshift(abs(fft2(bn1)))
-    h = highpass(f0.shape)
-    f0 *= h
-    f1 *= h
-    del h
-    f0, log_base = logpolar(f0)
+    f1 *= highpass(f1.shape)
     f1, log_base = logpolar(f1)
-    f0 = fft2(f0)
     f1 = fft2(f1)
     r0 = abs(f0) * abs(f1)
     ir = abs(ifft2((f0 * f1.conjugate()) / r0))
@@ -689,7 +1018,7 @@ Modified from Imreg.py, see http://www.lfd.uci.edu/~gohlke/:
         bn2 = t
     elif bn2.shape > bn0.shape:
         bn2 = bn2[:bn0.shape[0], :bn0.shape[1]] 
-    f0 = fft2(bn0)
+    f0 = F0
     f1 = fft2(bn2)
     ir = abs(ifft2((f0 * f1.conjugate()) / (abs(f0) * abs(f1))))
     t0, t1 = np.unravel_index(np.argmax(ir), ir.shape)
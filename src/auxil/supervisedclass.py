@@ -19,14 +19,58 @@
 
 
 import numpy as np  
-from mlpy import MaximumLikelihoodC, LibSvm  
+from mlpy import LibSvm  
+from .auxil import BlockReader, BlockWriter, imapordered
 
 epochs = 1000     
 
-class Maxlike(MaximumLikelihoodC):
+def classifyimage(classifier,rasterBands,minx,maxx,outDataset,
+                  probDataset=None,workers=4,nrows=None):
+    '''Classify the image in rasterBands with a trained classifier
+       (Maxlike, Ffnbp, Ffncg or Svm) in multi-row tiles, which are
+       stretched with the training minima minx and maxima maxx to
+       [-1,1] and classified concurrently in a pool of workers
+       threads. The classes are written to outDataset and, if the
+       classifier returns them, the class probabilities (times 255)
+       to probDataset. The tiles are written in image order'''
+    cols = outDataset.RasterXSize
+    rows = outDataset.RasterYSize
+    N = len(rasterBands)
+    reader = BlockReader(rasterBands,[(0,0)]*N,cols,rows,nrows)
+    minx = np.asarray(minx,dtype=np.float64)
+    scale = 2.0/(np.asarray(maxx,dtype=np.float64)-minx)
+    def classifytile((row,nrows,tile)):
+        tile -= minx
+        tile *= scale
+        tile -= 1.0
+        return classifier.classify(tile.astype(np.float32))
+    def tiles():
+        for row in range(0,rows,reader.nrows):
+            nrows = min(reader.nrows,rows-row)
+            yield (row,nrows,reader.read(row,nrows))
+    outWriter = BlockWriter(outDataset,reader.nrows,np.uint8)
+    if probDataset is not None:
+        probWriter = BlockWriter(probDataset,reader.nrows,np.uint8)
+#  tiles are read at most two per thread ahead of the writer
+    results = imapordered(classifytile,tiles(),workers)
+    try:
+        for cls,Ms in results:
+            outWriter.write(np.reshape(np.asarray(cls,dtype=np.uint8),(-1,1)))
+            if (probDataset is not None) and (Ms is not None):
+                probWriter.write(np.asarray(np.transpose(Ms)*255,dtype=np.uint8))
+    finally:
+        results.close()
+    outWriter.close()
+    if probDataset is not None:
+        probWriter.close()
+
+class Maxlike(object):
+    '''Gaussian maximum likelihood classifier. Training
+       precomputes the inverse Cholesky factors and the log 
+       determinants of the class covariance matrices, so that 
+       a tile is scored against all classes with one GEMM'''
      
     def __init__(self,Gs,ls): 
-        MaximumLikelihoodC.__init__(self)
         self._K = ls.shape[1] 
         self._Gs = Gs 
         self._N = Gs.shape[1]
@@ -35,24 +79,44 @@ class Maxlike(MaximumLikelihoodC):
     def train(self):
         try: 
             labels = np.argmax(self._ls,axis=1)
-            idx = np.where(labels == 0)[0]
-            ls = np.ones(len(idx),dtype=np.int)
-            Gs = self._Gs[idx,:]
-            for k in range(1,self._K):
-                idx = np.where(labels == k)[0]
-                ls = np.concatenate((ls, \
-                (k+1)*np.ones(len(idx),dtype=np.int)))
-                Gs = np.concatenate((Gs,\
-                               self._Gs[idx,:]),axis=0)         
-            self.learn(Gs,ls)    
+            m = len(labels)
+            K,N = self._K,self._N
+#          classes without training pixels are never assigned               
+            self._d0 = np.empty(K)
+            self._d0.fill(-np.inf)
+            self._W = np.zeros((K*N,N))
+            self._c = np.zeros(K*N)
+            for k in range(K):
+                Gs = self._Gs[labels == k,:]
+                if Gs.shape[0] == 0:
+                    continue
+                if Gs.shape[0] <= N:
+                    raise ValueError('too few training pixels in class %i'%(k+1))
+                M = np.mean(Gs,axis=0)
+                L = np.linalg.cholesky(np.cov(Gs,rowvar=0))
+                Li = np.linalg.inv(L)
+#              discriminant log(P) - log|C|/2 - |Li(g-M)|^2/2                
+                self._W[k*N:(k+1)*N,:] = Li
+                self._c[k*N:(k+1)*N] = np.dot(Li,M)
+                self._d0[k] = np.log(Gs.shape[0]/float(m)) \
+                                       - np.sum(np.log(np.diag(L)))
             return True 
         except Exception as e:
             print 'Error: %s'%e 
             return False    
             
     def classify(self,Gs):
-        classes = self.pred(Gs)
-        return (classes, None)    
+#      vectorized classes and posterior class probabilities        
+        m = Gs.shape[0]
+        Z = np.dot(Gs,self._W.T)
+        Z -= self._c
+        Z *= Z
+        D = self._d0 - 0.5*np.sum(np.reshape(Z,(m,self._K,self._N)),axis=2)
+        classes = np.argmax(D,axis=1)+1
+        D -= np.max(D,axis=1)[:,np.newaxis]
+        Ms = np.exp(D.T)
+        Ms /= np.sum(Ms,axis=0)
+        return (classes, Ms)    
     
     def test(self,Gs,ls):
         m = np.shape(Gs)[0]
@@ -145,13 +209,25 @@ class Ffn(object):
     
     
 class Ffnbp(Ffn):
+    '''Backpropagation, online (batch=None) or with mini-batches
+       of batch examples in float32, holding out the fraction 
+       holdout of the examples to stop training after patience 
+       epochs without improvement of their cost'''
     
-    def __init__(self,Gs,ls,L):
+    def __init__(self,Gs,ls,L,batch=None,eta=0.01,alpha=0.5,
+                                     holdout=0.1,patience=20):
         Ffn.__init__(self,Gs,ls,L)
+        self._batch = batch
+        self._eta = eta
+        self._alpha = alpha
+        self._holdout = holdout
+        self._patience = patience
            
     def train(self):
-        eta = 0.01
-        alpha = 0.5
+        if self._batch:
+            return self.trainbatch()
+        eta = self._eta
+        alpha = self._alpha
         maxitr = epochs*self._m 
         inc_o1 = 0.0
         inc_h1 = 0.0
@@ -187,6 +263,78 @@ class Ffnbp(Ffn):
             return None
         return np.array(cost)
     
+    def trainbatch(self):
+        eta = np.float32(self._eta)
+        alpha = np.float32(self._alpha)
+        b = max(int(self._batch),1)
+        try:
+#          biased examples and labels as float32 rows, split
+#          at random into training and validation sets
+            X = np.asarray(self._Gs.T,dtype=np.float32)
+            Y = np.asarray(self._ls.T,dtype=np.float32)
+            idx = np.random.permutation(self._m)
+            mv = int(self._holdout*self._m)
+            Xv,Yv = X[idx[:mv],:],Y[idx[:mv],:]
+            X,Y = X[idx[mv:],:],Y[idx[mv:],:]
+            m = X.shape[0]
+            Wh = np.asarray(self._Wh,dtype=np.float32)
+            Wo = np.asarray(self._Wo,dtype=np.float32)
+            inc_h1 = np.zeros_like(Wh)
+            inc_o1 = np.zeros_like(Wo)
+            best = (np.inf,Wh.copy(),Wo.copy())
+            wait = 0
+            cost = []
+            for epoch in range(epochs):
+                idx = np.random.permutation(m)
+                for i in range(0,m,b):
+                    Xb,Yb = X[idx[i:i+b],:],Y[idx[i:i+b],:]
+#                  send the batch through the network
+                    M,n = self.bforwardpass(Xb,Wh,Wo)
+#                  determine the deltas
+                    d_o = Yb - M
+                    d_h = n[:,1:]*(1-n[:,1:])*np.dot(d_o,Wo[1:,:].T)
+#                  update synaptic weights with the summed gradients
+                    inc_o = eta*np.dot(n.T,d_o)
+                    inc_h = eta*np.dot(Xb.T,d_h)
+                    Wo += inc_o + alpha*inc_o1
+                    Wh += inc_h + alpha*inc_h1
+                    inc_o1 = inc_o
+                    inc_h1 = inc_h
+#              record cost function, stop early on the validation set
+                M,_ = self.bforwardpass(X,Wh,Wo)
+                cost.append(-np.sum(Y*np.log(M+1e-20),dtype=np.float64))
+                if mv > 0:
+                    M,_ = self.bforwardpass(Xv,Wh,Wo)
+                    vcost = -np.sum(Yv*np.log(M+1e-20),dtype=np.float64)
+                    if vcost < best[0]:
+                        best = (vcost,Wh.copy(),Wo.copy())
+                        wait = 0
+                    else:
+                        wait += 1
+                        if wait >= self._patience:
+                            break
+            if mv > 0:
+                _,Wh,Wo = best
+            self._Wh = np.mat(Wh,dtype=np.float64)
+            self._Wo = np.mat(Wo,dtype=np.float64)
+        except Exception as e:
+            print 'Error: %s'%e
+            return None
+        return np.array(cost)
+    
+    def bforwardpass(self,X,Wh,Wo):
+#      forward pass of biased row vectors X, returns the
+#      softmax outputs and the biased hidden layer outputs
+        expnt = np.clip(np.dot(X,Wh),-100.0,100.0)
+        n = np.empty((X.shape[0],Wh.shape[1]+1),dtype=X.dtype)
+        n[:,0] = 1.0
+        n[:,1:] = 1.0/(1+np.exp(-expnt))
+        I = np.dot(n,Wo)
+        I -= np.max(I,axis=1)[:,np.newaxis]
+        A = np.exp(I)
+        A /= np.sum(A,axis=1)[:,np.newaxis]
+        return (A,n)
+    
 class Ffncg(Ffn):
     
     def __init__(self,Gs,ls,L):
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+#******************************************************************************
+#  Name:     training.py
+#  Purpose:  training pixel vectors for supervised classification from
+#            polygons in a shapefile with CLASS_ID and CLASS_NAME fields
+#  Usage:
+#     import training
+#
+#  Copyright (c) 2015, Mort Canty
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+import numpy as np
+import os, hashlib, tempfile
+from osgeo import gdal, ogr, osr
+from osgeo.gdalconst import GDT_UInt16
+from .auxil import BlockReader
+
+# label of pixels outside the training polygons
+NOCLASS = 65535
+
+def window(inDataset,trnLayer):
+#  pixel window (x0,y0,cols,rows) of the image covering the
+#  extent of the training layer, padded by one pixel and
+#  clipped to the image
+    gt = inDataset.GetGeoTransform()
+    imsr = osr.SpatialReference()
+    imsr.ImportFromWkt(inDataset.GetProjection())
+    ct = osr.CoordinateTransformation(trnLayer.GetSpatialRef(),imsr)
+    minx,maxx,miny,maxy = trnLayer.GetExtent()
+    corners = np.array([ct.TransformPoint(x,y)[:2] for x in (minx,maxx)
+                                                    for y in (miny,maxy)])
+#  map coordinates to pixel coordinates
+    GT = np.array([[gt[1],gt[2]],[gt[4],gt[5]]])
+    ij = np.dot(corners-[gt[0],gt[3]],np.linalg.inv(GT).T)
+    x0 = max(int(np.floor(np.min(ij[:,0])))-1,0)
+    y0 = max(int(np.floor(np.min(ij[:,1])))-1,0)
+    x1 = min(int(np.ceil(np.max(ij[:,0])))+1,inDataset.RasterXSize)
+    y1 = min(int(np.ceil(np.max(ij[:,1])))+1,inDataset.RasterYSize)
+    return (x0,y0,max(x1-x0,0),max(y1-y0,0))
+
+def rasterize(inDataset,trnLayer,dims):
+#  burn the CLASS_ID of the training polygons into a label
+#  raster over the image window dims, pixels are labeled if
+#  their centers lie inside a polygon
+    x0,y0,cols,rows = dims
+    gt = list(inDataset.GetGeoTransform())
+    gt[0] = gt[0] + x0*gt[1] + y0*gt[2]
+    gt[3] = gt[3] + x0*gt[4] + y0*gt[5]
+    lblDataset = gdal.GetDriverByName('MEM').Create('',cols,rows,1,GDT_UInt16)
+    lblDataset.SetGeoTransform(tuple(gt))
+    lblDataset.SetProjection(inDataset.GetProjection())
+    lblBand = lblDataset.GetRasterBand(1)
+    lblBand.Fill(NOCLASS)
+#  the layer is reprojected to the image projection on the fly
+    gdal.RasterizeLayer(lblDataset,[1],trnLayer,options=['ATTRIBUTE=CLASS_ID'])
+    labels = lblBand.ReadAsArray()
+    lblDataset = None
+    return labels
+
+def cachekey(inDataset,trnfile,pos):
+#  hash of the image path, size and modification time, the
+#  band positions and the contents of the shapefile components
+    key = hashlib.sha1()
+    fn = os.path.abspath(inDataset.GetDescription())
+    if os.path.exists(fn):
+        st = os.stat(fn)
+        key.update('%s %i %f'%(fn,st.st_size,st.st_mtime))
+    else:
+        key.update(fn)
+    key.update(str(list(pos)))
+    root = os.path.splitext(trnfile)[0]
+    for ext in ('.shp','.shx','.dbf','.prj'):
+        if os.path.exists(root+ext):
+            with open(root+ext,'rb') as f:
+                for chunk in iter(lambda: f.read(2**20),''):
+                    key.update(chunk)
+    return key.hexdigest()
+
+def evict(cache,entries):
+#  remove all but the entries most recently used cache files
+    fns = [os.path.join(cache,fn) for fn in os.listdir(cache)
+                                  if fn.endswith('.npz')]
+    fns.sort(key=os.path.getmtime,reverse=True)
+    for fn in fns[entries:]:
+        try:
+            os.remove(fn)
+        except OSError:
+            pass
+
+def readtraining(inDataset,trnfile,pos=None,cache=None,entries=32):
+    '''Training pixel vectors of image inDataset in bands pos
+       (default all) from the polygons of shapefile trnfile.
+       All polygons are rasterized in one pass. If a cache
+       directory is given, the result is stored there keyed by
+       image, band positions and shapefile and read back on
+       later calls, keeping the entries most recently used.
+       Returns (Gs,ls,K,classnames) with the (m,N) pixel vectors,
+       their (m,K) one-hot class labels indexed by CLASS_ID, the
+       number of labels and the class names'''
+    if pos is None:
+        pos = range(1,inDataset.RasterCount+1)
+    if cache is None:
+        return extract(inDataset,trnfile,pos)
+    if not os.path.isdir(cache):
+        os.makedirs(cache)
+    fn = os.path.join(cache,cachekey(inDataset,trnfile,pos)+'.npz')
+    if os.path.exists(fn):
+        try:
+            npz = np.load(fn)
+            result = (npz['Gs'],npz['ls'],int(npz['K']),str(npz['classnames']))
+            npz.close()
+#          mark as recently used
+            os.utime(fn,None)
+            return result
+        except Exception:
+            pass
+    Gs,ls,K,classnames = extract(inDataset,trnfile,pos)
+#  written under a temporary name and renamed, so that concurrent
+#  runs never read a partial entry
+    fd,tmpfn = tempfile.mkstemp(suffix='.tmp',dir=cache)
+    with os.fdopen(fd,'wb') as f:
+        np.savez(f,Gs=Gs,ls=ls,K=K,classnames=classnames)
+    os.rename(tmpfn,fn)
+    evict(cache,entries)
+    return (Gs,ls,K,classnames)
+
+def extract(inDataset,trnfile,pos):
+#  training pixel vectors, see readtraining
+    if inDataset.GetGeoTransform() is None:
+        raise ValueError('No geotransform available')
+    trnDriver = ogr.GetDriverByName('ESRI Shapefile')
+    trnDatasource = trnDriver.Open(trnfile,0)
+    if trnDatasource is None:
+        raise ValueError('Shapefile could not be read')
+    trnLayer = trnDatasource.GetLayer()
+#  number of classes and class names
+    K = 1
+    classnames = '{unclassified'
+    classids = set()
+    feature = trnLayer.GetNextFeature()
+    while feature:
+        classid = int(feature.GetField('CLASS_ID'))
+        if classid >= NOCLASS:
+            raise ValueError('CLASS_ID out of range: %i'%classid)
+        if classid not in classids:
+            classnames += ',   '+feature.GetField('CLASS_NAME')
+            classids.add(classid)
+        K = max(K,classid)
+        feature.Destroy()
+        feature = trnLayer.GetNextFeature()
+    trnLayer.ResetReading()
+    K += 1
+    classnames += '}'
+#  label raster over the training polygons
+    dims = window(inDataset,trnLayer)
+    x0,y0,cols,rows = dims
+    if cols*rows > 0:
+        labels = rasterize(inDataset,trnLayer,dims)
+    trnDatasource.Destroy()
+#  gather the labeled pixel vectors tile by tile
+    Gs = []
+    cs = []
+    if cols*rows > 0:
+        rasterBands = [inDataset.GetRasterBand(b) for b in pos]
+        reader = BlockReader(rasterBands,[(x0,y0)]*len(pos),cols,rows)
+        for row in range(0,rows,reader.nrows):
+            nrows = min(reader.nrows,rows-row)
+            lbl = labels[row:row+nrows,:].ravel()
+            idx = np.where(lbl != NOCLASS)[0]
+            if len(idx) > 0:
+                Gs.append(reader.read(row,nrows)[idx,:])
+                cs.append(lbl[idx])
+    if len(Gs) == 0:
+        raise ValueError('No training pixels inside the image')
+    Gs = np.concatenate(Gs)
+    cs = np.concatenate(cs).astype(int)
+    ls = np.zeros((len(cs),K))
+    ls[np.arange(len(cs)),cs] = 1.0
+    return (Gs,ls,K,classnames)
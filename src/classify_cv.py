@@ -17,21 +17,20 @@
 #    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 #    GNU General Public License for more details.
 import auxil.supervisedclass as sc
-import gdal, ogr, osr, os, time, sys, getopt
+from auxil.training import readtraining
+import gdal, os, time, sys, getopt
 from osgeo.gdalconst import GA_ReadOnly, GDT_Byte
-from shapely.geometry import asPolygon, MultiPoint
 import matplotlib.pyplot as plt
-import shapely.wkt  
 import numpy as np
 from IPython.parallel import Client
 
 
-def crossvalidate((Gstrn,lstrn,Gstst,lstst,L,trainalg)):
+def crossvalidate((Gstrn,lstrn,Gstst,lstst,L,trainalg,batch)):
     import auxil.supervisedclass as sc
     if   trainalg == 1:
         classifier = sc.Maxlike(Gstrn,lstrn)
     elif trainalg == 2:
-        classifier = sc.Ffnbp(Gstrn,lstrn,L)
+        classifier = sc.Ffnbp(Gstrn,lstrn,L,batch)
     elif trainalg == 3:
         classifier = sc.Ffncg(Gstrn,lstrn,L)
     elif trainalg == 4:
@@ -46,7 +45,8 @@ def main():
 Usage: 
 ---------------------------------------------------------
 python %s  [-p bandPositions] [- a algorithm] [-L number of hidden neurons]   
-[-P generate class probabilities image] filename trainShapefile
+[-P generate class probabilities image] [-c cache directory]
+[-j threads] [-b mini-batch size] filename trainShapefile
 
 bandPositions is a list, e.g., -p [1,2,4]  
 
@@ -70,11 +70,22 @@ the class probabilities output file is named
 and the test results file is named
 
          path/filebasename_<classifier>.tst
+
+With -c the training pixel vectors are cached in the
+given directory and reused as long as image, band 
+positions and shapefile are unchanged (default no cache).
+The image is classified in tiles by -j threads (default 4).
+With -b the backprop network is trained on mini-batches,
+stopping early on a held-out tenth of the training data
+(default online training)
 --------------------------------------------------------''' %sys.argv[0]
-    options, args = getopt.getopt(sys.argv[1:],'hnPp:a:L:')
+    options, args = getopt.getopt(sys.argv[1:],'hnPp:a:L:c:j:b:')
     pos = None
     probs = False   
     L = 8
+    cache = None
+    workers = 4
+    batch = None
     graphics = True
     trainalg = 1
     for option, value in options:
@@ -90,7 +101,13 @@ and the test results file is named
         elif option == '-L':
             L = eval(value)    
         elif option == '-P':
-            probs = True                              
+            probs = True
+        elif option == '-c':
+            cache = value
+        elif option == '-j':
+            workers = eval(value)
+        elif option == '-b':
+            batch = eval(value)
     if len(args) != 2: 
         print 'Incorrect number of arguments'
         print usage
@@ -118,8 +135,6 @@ and the test results file is named
         else:
             print 'No geotransform available'
             return       
-        imsr = osr.SpatialReference()  
-        imsr.ImportFromWkt(projection)    
     else:
         return  
     if pos is None: 
@@ -134,28 +149,11 @@ and the test results file is named
     root, ext = os.path.splitext(basename)
     outfile = '%s/%s_class%s'%(path,root,ext)  
     tstfile = '%s/%s_%s.tst'%(path,root,algorithm)            
-    if (trainalg in (2,3,4)) and probs:
+    if probs:
 #      class probabilities file
         probfile = '%s/%s_classprobs%s'%(path,root,ext) 
     else:
         probfile = None        
-#  training data        
-    trnDriver = ogr.GetDriverByName('ESRI Shapefile')
-    trnDatasource = trnDriver.Open(trnfile,0)
-    trnLayer = trnDatasource.GetLayer() 
-    trnsr = trnLayer.GetSpatialRef()             
-#  coordinate transformation from training to image projection   
-    ct = osr.CoordinateTransformation(trnsr,imsr) 
-#  number of classes    
-    K = 1
-    feature = trnLayer.GetNextFeature() 
-    while feature:
-        classid = feature.GetField('CLASS_ID')
-        if int(classid)>K:
-            K = int(classid)
-        feature = trnLayer.GetNextFeature() 
-    trnLayer.ResetReading()    
-    K += 1       
 #  es kann losgehen    
     print '========================='
     print 'supervised classification'
@@ -164,63 +162,15 @@ and the test results file is named
     print 'image:     '+infile
     print 'training:  '+trnfile  
     print 'algorithm: '+algorithm             
-#  loop through the polygons    
-    Gs = [] # train observations
-    ls = [] # class labels
-    classnames = '{unclassified'
-    classids = set()
+#  rasterize the training polygons or read them from the cache
     print 'reading training data...'
-    for i in range(trnLayer.GetFeatureCount()):
-        feature = trnLayer.GetFeature(i)
-        classid = str(feature.GetField('CLASS_ID'))
-        classname  = feature.GetField('CLASS_NAME')
-        if classid not in classids:
-            classnames += ',   '+ classname
-        classids = classids | set(classid)     
-#      label for this ROI           
-        l = [0 for i in range(K)]
-        l[int(classid)] = 1.0
-        polygon = feature.GetGeometryRef()
-#      transform to same projection as image        
-        polygon.Transform(ct)  
-#      convert to a Shapely object            
-        poly = shapely.wkt.loads(polygon.ExportToWkt())
-#      transform the boundary to pixel coords in numpy        
-        bdry = np.array(poly.boundary) 
-        bdry[:,0] = bdry[:,0]-gt[0]
-        bdry[:,1] = bdry[:,1]-gt[3]
-        GT = np.mat([[gt[1],gt[2]],[gt[4],gt[5]]])
-        bdry = bdry*np.linalg.inv(GT) 
-#      polygon in pixel coords        
-        polygon1 = asPolygon(bdry)
-#      raster over the bounding rectangle        
-        minx,miny,maxx,maxy = map(int,list(polygon1.bounds))  
-        pts = [] 
-        for i in range(minx,maxx+1):
-            for j in range(miny,maxy+1): 
-                pts.append((i,j))             
-        multipt =  MultiPoint(pts)   
-#      intersection as list              
-        intersection = np.array(multipt.intersection(polygon1),dtype=np.int).tolist()
-#      cut out the bounded image cube               
-        cube = np.zeros((maxy-miny+1,maxx-minx+1,len(rasterBands)))
-        k=0
-        for band in rasterBands:
-            cube[:,:,k] = band.ReadAsArray(minx,miny,maxx-minx+1,maxy-miny+1)
-            k += 1
-#      get the training vectors
-        for (x,y) in intersection:         
-            Gs.append(cube[y-miny,x-minx,:])
-            ls.append(l)   
-        polygon = None
-        polygon1 = None            
-        feature.Destroy()  
-    trnDatasource.Destroy() 
-    classnames += '}'
-    m = len(ls)       
+    try:
+        Gs,ls,K,classnames = readtraining(inDataset,trnfile,pos,cache)
+    except Exception as e:
+        print 'Error: %s  --Training data could not be read.'%e
+        return
+    m = ls.shape[0]
     print str(m) + ' training pixel vectors were read in' 
-    Gs = np.array(Gs) 
-    ls = np.array(ls)
 #  stretch the pixel vectors to [-1,1] (for ffn)
     maxx = np.max(Gs,0)
     minx = np.min(Gs,0)
@@ -239,21 +189,19 @@ and the test results file is named
         outDataset.SetGeoTransform(tuple(gt))
     if projection is not None:
         outDataset.SetProjection(projection) 
-    outBand = outDataset.GetRasterBand(1) 
     if probfile:   
         probDataset = driver.Create(probfile,cols,rows,K,GDT_Byte) 
         if geotransform is not None:
             probDataset.SetGeoTransform(tuple(gt))
         if projection is not None:
             probDataset.SetProjection(projection)  
-        probBands = [] 
-        for k in range(K):
-            probBands.append(probDataset.GetRasterBand(k+1))         
+    else:
+        probDataset = None
 #  initialize classifier  
     if   trainalg == 1:
         classifier = sc.Maxlike(Gs,ls)
     elif trainalg == 2:
-        classifier = sc.Ffnbp(Gs,ls,L)
+        classifier = sc.Ffnbp(Gs,ls,L,batch)
     elif trainalg == 3:
         classifier = sc.Ffncg(Gs,ls,L)
     elif trainalg == 4:
@@ -277,24 +225,12 @@ and the test results file is named
 #      classify the image           
         print 'classifying...'
         start = time.time()
-        tile = np.zeros((cols,N),dtype=np.float32)    
-        for row in range(rows):
-            for j in range(N):
-                tile[:,j] = rasterBands[j].ReadAsArray(0,row,cols,1)
-                tile[:,j] = 2*(tile[:,j]-minx[j])/(maxx[j]-minx[j]) - 1.0               
-            cls, Ms = classifier.classify(tile)  
-            outBand.WriteArray(np.reshape(cls,(1,cols)),0,row)
-            if probfile:
-                Ms = np.byte(Ms*255)
-                for k in range(K):
-                    probBands[k].WriteArray(np.reshape(Ms[k,:],(1,cols)),0,row)
-        outBand.FlushCache()
+        sc.classifyimage(classifier,rasterBands,minx,maxx,outDataset,
+                         probDataset,workers)
         print 'elapsed time %s' %str(time.time()-start)
         outDataset = None
         inDataset = None      
         if probfile:
-            for probBand in probBands:
-                probBand.FlushCache() 
             probDataset = None
             print 'class probabilities written to: %s'%probfile   
         K =  ls.shape[1]+1                     
@@ -311,7 +247,7 @@ and the test results file is named
     for i in range(10):
         sl = slice(i*m//10,(i+1)*m//10)
         traintest.append( (np.delete(Gs,sl,0),np.delete(ls,sl,0), \
-                                     Gs[sl,:],ls[sl,:],L,trainalg) )
+                                     Gs[sl,:],ls[sl,:],L,trainalg,batch) )
     v = rc[:]   
     v.execute('import auxil.supervisedclass as sc') 
     result = v.map(crossvalidate,traintest).get()   
@@ -21,83 +21,350 @@ import auxil.header as header
 from auxil.auxil import ctable
 import os, sys, time, getopt
 import numpy as np
+from multiprocessing import Pool
+from multiprocessing.sharedctypes import RawArray
 import scipy.ndimage.interpolation as ndi
 import scipy.ndimage.filters as ndf
 from osgeo import gdal
 from osgeo.gdalconst import GA_ReadOnly, GDT_Byte
 
-def em(G,U,T0,beta,rows,cols,unfrozen=None):
+#  arrays shared with forked EM worker processes
+_em = None
+
+def quadcoeffs(Ms,L):
+#  coefficients (W,c) of the quadratic forms, see quadforms
+    K,N = Ms.shape
+    iu,ju = np.triu_indices(N)
+    Linv = np.linalg.inv(L)
+    P = np.einsum('kji,kjl->kil',Linv,Linv)
+    Pm = np.einsum('kij,kj->ki',P,Ms)
+    W = np.hstack((P[:,iu,ju]*np.where(iu==ju,1.0,2.0),-2*Pm))
+    c = np.einsum('ki,ki->k',Pm,Ms)
+    return (W,c)
+
+def quadforms(H,Ms,L,out=None):
+#  squared Mahalanobis distances (K,n) of the pixel vectors from
+#  the cluster means Ms, given the Cholesky factors L of the 
+#  cluster covariance matrices. The rows of H hold the pairwise
+#  products of the vector components followed by the components,
+#  so the K quadratic forms are evaluated with a single GEMM
+    W,c = quadcoeffs(Ms,L)
+    qf = np.dot(W.astype(H.dtype),H.T,out=out)
+    qf += c[:,np.newaxis]
+    return qf
+
+def memberships(H,Ms,L,Ps):
+#  normalized spectral class memberships (K,n) and quadratic
+#  forms for pixel vector products H, see quadforms
+    qf = quadforms(H,Ms,L)
+    fhv = np.exp(np.sum(np.log(np.diagonal(L,axis1=1,axis2=2)),axis=1))
+    U = np.exp(-qf/2.0)*(Ps/fhv)[:,np.newaxis]
+    a = np.sum(U,axis=0)
+    a[a == 0] = 1.0
+    U /= a
+    return (U,qf)
+
+def em_minibatch(G,U,batch,beta=0.0,rows=None,cols=None,steps=100,
+                 kappa=0.6,t0=20,chunk=2**16):
+#  mini-batch (stochastic) EM: the sufficient statistics are
+#  running averages over random batches of pixels, updated with
+#  step sizes min(1,(t/t0)**(-kappa)) in step t. The initial
+#  memberships U provide the statistics of the first batch, 
+#  the returned memberships are those of all pixels under the
+#  final mixture parameters, combined with the spatial term of
+#  their own rows by cols neighbourhood if beta > 0. There is 
+#  no annealing, the random batches take its place
     K,n = U.shape
     N = G.shape[1]
-    if unfrozen is None:
-        unfrozen = range(n)
-    V = U*0.0
-    Nb = np.array([[0.0,0.25,0.0],[0.25,0.0,0.25],[0.0,0.25,0.0]])
-    Cs = np.zeros((K,N,N))
+    iu,ju = np.triu_indices(N)
+    m = len(iu)
+    G0 = np.mean(G,axis=0)
+    batch = min(batch,n)
+    print 'running mini-batch EM on %i pixel vectors, batch size %i'%(n,batch)
+    S = None
+    for t in range(1,steps+1):
+        idx = np.random.randint(0,n,batch)
+        Hb = products(G[idx,:] - G0)
+        if S is None:
+            Ub = U[:,idx]
+        else:
+            Ub,_ = memberships(Hb,Ms,L,Ps)
+#      batch sufficient statistics        
+        Sb = np.hstack((np.sum(Ub,axis=1)[:,np.newaxis],np.dot(Ub,Hb)))/batch
+        if S is None:
+            S = Sb
+        else:
+            gamma = min(1.0,(float(t)/t0)**(-kappa))
+            S = (1.0-gamma)*S + gamma*Sb
+#      mixture parameters             
+        Ps = S[:,0]
+        Ms = S[:,m+1:]/Ps[:,np.newaxis]
+        C = S[:,1:m+1]/Ps[:,np.newaxis] - Ms[:,iu]*Ms[:,ju]
+        Cs = np.zeros((K,N,N))
+        Cs[:,iu,ju] = C
+        Cs[:,ju,iu] = C
+        L = np.linalg.cholesky(Cs)
+        if (t % 10) == 0:
+            print 'mini-batch em step %i'%t
+#  memberships and partition densities of all pixels    
+    fhv = np.exp(np.sum(np.log(np.diagonal(L,axis1=1,axis2=2)),axis=1))
     pdens = np.zeros(K)
-    fhv = np.zeros(K)
-    dU = 1.0
-    itr = 0
-    T = T0
-    print 'running EM on %i pixel vectors'%n
-    while ((dU > 0.001) or (itr < 10)) and (itr < 500):
-        Uold = U+0.0
-        ns = np.sum(U,axis=1)
-#      prior probabilities
-        Ps = np.asarray(ns/n).ravel()
-#      cluster means
-        Ms = np.asarray((np.mat(U)*np.mat(G)).T)
-#      loop over the cluster index
+    for i in range(0,n,chunk):
+        U[:,i:i+chunk],qf = memberships(products(G[i:i+chunk,:]-G0),Ms,L,Ps)
+        pdens += np.sum(np.where(qf < 1.0,U[:,i:i+chunk],0.0),axis=1)
+#  one spatial step on the spectral memberships, as in em_spatial    
+    if (beta > 0) and (rows is not None):
+        Nb = np.array([[0.0,0.25,0.0],[0.25,0.0,0.25],[0.0,0.25,0.0]])
+        Us = U.copy()
         for k in range(K):
-            Ms[:,k] = Ms[:,k]/ns[k]
-            W = np.tile(Ms[:,k].ravel(),(n,1))
-            Ds = G - W
-#          covariance matrix
-            for i in range(N):
-                W[:,i] = np.sqrt(U[k,:]) \
-                    .ravel()*Ds[:,i].ravel()             
-            C = np.mat(W).T*np.mat(W)/ns[k]
-            Cs[k,:,:] = C
-            sqrtdetC = np.sqrt(np.linalg.det(C))
-            Cinv = np.linalg.inv(C)
-            qf = np.asarray(np.sum(np.multiply(Ds \
-                        ,np.mat(Ds)*Cinv),1)).ravel()
-#          class hypervolume and partition density
-            fhv[k] = sqrtdetC
-            idx = np.where(qf < 1.0)
-            pdens[k] = np.sum(U[k,idx])/fhv[k]
-#          new memberships
-            U[k,unfrozen] = np.exp(-qf[unfrozen]/2.0)\
-                   *(Ps[k]/sqrtdetC)
-#          random membership for annealing
-            if T > 0.0:
-                Ur = 1.0 - np.random\
-                     .random(len(unfrozen))**(1.0/T)
-                U[k,unfrozen] = U[k,unfrozen]*Ur
-#      spatial membership            
-        if beta > 0:
-            for k in range(K):
-                U_N = 1.0 - ndf.convolve(np.reshape(U[k,:],(rows,cols)),Nb)
-                V[k,:] = np.exp(-beta*U_N).ravel()                        
-#          combine spectral/spatial
-            U[:,unfrozen] = U[:,unfrozen]*V[:,unfrozen] 
-#      normalize all
+            V = ndf.convolve(np.reshape(Us[k,:],(rows,cols)),Nb).ravel()
+            V -= 1.0
+            V *= beta
+            U[k,:] *= np.exp(V)
         a = np.sum(U,axis=0)
-        idx = np.where(a == 0)[0]
-        a[idx] = 1.0
+        a[a == 0] = 1.0
+        U /= a
+    return (U,Ms+G0,Cs,Ps,pdens/fhv)
+
+def shared(shape,dtype,workers=1):
+#  uninitialized array, in shared memory for several workers
+    if workers > 1:
+        typecode = np.dtype(dtype).char
+        size = int(np.prod(shape))
+        return np.reshape(np.frombuffer(RawArray(typecode,size),dtype),shape)
+    else:
+        return np.empty(shape,dtype)
+
+def products(G):
+#  pairwise products of the pixel vector components followed 
+#  by the components, see quadforms    
+    iu,ju = np.triu_indices(G.shape[1])
+    return np.hstack((G[:,iu]*G[:,ju],G))
+
+def em_stats((b,cur)):
+#  partial sufficient statistics of the pixels in block b:
+#  summed memberships and membership weighted sums of H
+    c0,c1 = _em['blocks'][b]
+    U = _em['U'][cur][:,c0:c1]
+    H = _em['H'][c0:c1,:]
+    return np.hstack((np.sum(U,axis=1,dtype=np.float64)[:,np.newaxis],
+                      np.dot(U,H)))
+
+def em_spectral((b,cur,W,c,scale,T,seed)):
+#  spectral memberships of the pixels in block b
+    c0,c1 = _em['blocks'][b]
+    Unew = _em['U'][1-cur][:,c0:c1]
+    H = _em['H'][c0:c1,:]
+    K = Unew.shape[0]
+    W = W.astype(H.dtype)
+    qf = Unew
+    for k in range(K):
+        np.dot(H,W[k,:],out=qf[k,:])
+    qf += c[:,np.newaxis]
+    qf *= -0.5
+    np.exp(qf,out=Unew)
+    Unew *= scale[:,np.newaxis]
+#  random membership for annealing    
+    if T > 0.0:
+        random = np.random.RandomState(seed)
+        for k in range(K):
+            Ur = 1.0 - random.random_sample(c1-c0)**(1.0/T)
+            Unew[k,:] *= Ur
+    if _em['index'] is not None:
+#      the neighbours of unfrozen pixels are gathered from Ufull    
+        _em['Ufull'][:,_em['index'][c0:c1]] = Unew
+    elif c1 > c0:
+#      boundary rows for the neighbouring blocks            
+        cols = _em['cols']
+        _em['halo'][:,2*b,:] = Unew[:,:cols]
+        _em['halo'][:,2*b+1,:] = Unew[:,-cols:]
+
+def em_spatial((b,cur,beta)):
+#  spatial memberships and normalization of the pixels in block
+#  b. Returns the partial log likelihood and largest membership 
+#  change
+    c0,c1 = _em['blocks'][b]
+    U = _em['U'][cur][:,c0:c1]
+    Unew = _em['U'][1-cur][:,c0:c1]
+    rows,cols = _em['rows'],_em['cols']
+    K = U.shape[0]
+    if c1 == c0:
+        return (0.0,0.0)
+    if (beta > 0) and (_em['index'] is not None):
+#      gather the four neighbours of the unfrozen pixels, image 
+#      edges are reflected as by ndf.convolve       
+        idx = _em['index'][c0:c1]
+        r = idx // cols
+        col = idx % cols
+        nbrs = [np.where(r > 0,idx-cols,idx),np.where(r < rows-1,idx+cols,idx),
+                np.where(col > 0,idx-1,idx),np.where(col < cols-1,idx+1,idx)]
         for k in range(K):
-            U[k,:] = U[k,:]/a                
-        T = 0.8*T 
-#      log likelihood
-        Uflat = U.ravel()
-        Uoldflat = Uold.ravel()
-        idx = np.where(U.flat)[0]
-        loglike = np.sum(Uoldflat[idx]*np.log(Uflat[idx]))
-        dU = np.max(Uflat-Uoldflat)  
-        if (itr % 10) == 0:
-            print 'em iteration %i: dU: %f loglike: %f'%(itr,dU,loglike)
-        itr += 1         
-    return (U,np.transpose(Ms),Cs,Ps,pdens)
+            Uk = _em['Ufull'][k,:]
+            V = Uk[nbrs[0]] + Uk[nbrs[1]] + Uk[nbrs[2]] + Uk[nbrs[3]]
+            V *= 0.25
+            V -= 1.0
+            V *= beta
+            np.exp(V,out=V)
+#          combine spectral/spatial
+            Unew[k,:] *= V
+    elif beta > 0:
+#      convolve the row block, its neighbourhood at the boundary
+#      rows is completed with the halo rows of the adjacent blocks       
+        Nb = np.array([[0.0,0.25,0.0],[0.25,0.0,0.25],[0.0,0.25,0.0]])
+        halo = _em['halo']
+        nrows = (c1 - c0)//cols
+        ext = np.empty((nrows+2,cols),dtype=U.dtype)
+        UN = np.empty_like(ext)
+        for k in range(K):
+            ext[1:-1,:] = np.reshape(Unew[k,:],(nrows,cols))
+#          image edges are reflected as by ndf.convolve            
+            if b > 0:
+                ext[0,:] = halo[k,2*b-1,:]
+            else:
+                ext[0,:] = ext[1,:]
+            if b < len(_em['blocks'])-1:
+                ext[-1,:] = halo[k,2*b+2,:]
+            else:
+                ext[-1,:] = ext[-2,:]
+            ndf.convolve(ext,Nb,output=UN)
+            V = UN[1:-1,:].ravel()
+            V -= 1.0
+            V *= beta
+            np.exp(V,out=V)
+#          combine spectral/spatial
+            Unew[k,:] *= V
+#  normalize all
+    a = np.sum(Unew,axis=0)
+    a[a == 0] = 1.0
+    Unew /= a
+#  log likelihood and largest membership change
+    loglike = 0.0
+    dU = 0.0
+    for k in range(K):
+        idx = np.where(Unew[k,:])[0]
+        loglike += np.sum(U[k,idx]*np.log(Unew[k,idx]),dtype=np.float64)
+        dU = max(dU,np.max(Unew[k,:]-U[k,:]))
+    return (loglike,dU)
+
+def em(G,U,T0,beta,rows,cols,unfrozen=None,workers=1,chunk=2**16):
+#  the memberships U are updated with the precision of their 
+#  dtype (float32 or float64), alternating with a single 
+#  scratch buffer of the same shape. With several workers the
+#  pixels are sharded in row blocks over forked processes which
+#  share the arrays and return partial sufficient statistics.
+#  If unfrozen pixels are given, only they are iterated, held
+#  compacted, and the frozen pixels enter the statistics as a
+#  constant and the spatial term through their memberships
+    global _em
+    K,n = U.shape
+    N = G.shape[1]
+    m = N*(N+1)//2
+    dtype = U.dtype
+    strips = auxil.rowstrips(rows,1,workers)
+#  the pixel vectors are centered to preserve precision in the
+#  products: cluster means and covariances are then one GEMM 
+    G0 = np.mean(G,axis=0)
+    S0 = np.zeros((K,1+m+N))
+    loglike0 = 0.0
+    if unfrozen is None:
+        index = None
+        Ufull = None
+        blocks = [(r0*cols,r1*cols) for r0,r1 in strips]
+        nu = n
+        H = shared((n,m+N),dtype,workers)
+        for i in range(0,n,chunk):
+            H[i:i+chunk,:] = products(G[i:i+chunk,:]-G0)
+        Us = [shared((K,n),dtype,workers),shared((K,n),dtype,workers)]
+        Us[0][:] = U
+    else:
+        index = np.unique(np.asarray(unfrozen).ravel())
+        nu = len(index)
+        blocks = [tuple(np.searchsorted(index,[r0*cols,r1*cols])) for r0,r1 in strips]
+        Ufull = shared((K,n),dtype,workers)
+        Ufull[:] = U
+        index = shared(nu,index.dtype,workers)
+        index[:] = np.unique(np.asarray(unfrozen).ravel())
+        H = shared((nu,m+N),dtype,workers)
+        Us = [shared((K,nu),dtype,workers),shared((K,nu),dtype,workers)]
+        for i in range(0,nu,chunk):
+            idx = index[i:i+chunk]
+            H[i:i+chunk,:] = products(G[idx,:]-G0)
+            Us[0][:,i:i+chunk] = U[:,idx]
+#      constant statistics and log likelihood of the frozen pixels            
+        frozen = np.ones(n,dtype=bool)
+        frozen[index] = False
+        frozen = np.where(frozen)[0]
+        for i in range(0,len(frozen),chunk):
+            idx = frozen[i:i+chunk]
+            Uf = U[:,idx]
+            S0 += np.hstack((np.sum(Uf,axis=1,dtype=np.float64)[:,np.newaxis],
+                             np.dot(Uf,products(G[idx,:]-G0))))
+            Uf = Uf[Uf > 0]
+            loglike0 += np.sum(Uf*np.log(Uf),dtype=np.float64)
+        del frozen
+    del U
+    _em = dict(U=Us,H=H,index=index,Ufull=Ufull,rows=rows,cols=cols,blocks=blocks,
+               halo=shared((K,2*len(strips),cols),dtype,workers))
+    if len(strips) > 1:
+        pool = Pool(len(strips))
+        mapper = pool.map
+    else:
+        pool = None
+        mapper = map
+    nblocks = range(len(blocks))
+    iu,ju = np.triu_indices(N)
+    Cs = np.zeros((K,N,N),dtype=dtype)
+    cur = 0
+    dU = 1.0
+    itr = 0
+    T = T0
+    print 'running EM on %i of %i pixel vectors'%(nu,n)
+    try:
+        while ((dU > 0.001) or (itr < 10)) and (itr < 500):
+            S = S0 + np.sum(mapper(em_stats,[(b,cur) for b in nblocks]),axis=0)
+            ns = S[:,0]
+#          prior probabilities
+            Ps = ns/n
+#          cluster means and covariance matrices
+            S = S[:,1:]/ns[:,np.newaxis]
+            Ms = S[:,m:]
+            C = S[:,:m] - Ms[:,iu]*Ms[:,ju]
+            Cs[:,iu,ju] = C
+            Cs[:,ju,iu] = C
+            L = np.linalg.cholesky(Cs)
+            W,c = quadcoeffs(Ms,L)
+#          class hypervolumes            
+            fhv = np.exp(np.sum(np.log(np.diagonal(L,axis1=1,axis2=2)),axis=1))
+            seed = np.random.randint(2**31-len(blocks)) if T > 0.0 else 0
+            mapper(em_spectral,[(b,cur,W,c,Ps/fhv,T,seed+b) for b in nblocks])
+            result = mapper(em_spatial,[(b,cur,beta) for b in nblocks])
+            loglike = loglike0 + sum([r[0] for r in result])
+            dU = max([r[1] for r in result])
+            cur = 1 - cur
+            T = 0.8*T 
+            if (itr % 10) == 0:
+                print 'em iteration %i: dU: %f loglike: %f'%(itr,dU,loglike)
+            itr += 1     
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        _em = None
+#  partition densities of the memberships before the last update
+    if index is None:
+        U = Us[1-cur]
+    else:
+        U = Ufull
+        U[:,index] = Us[1-cur]
+    pdens = np.zeros(K)
+    for i in range(0,n,chunk):
+        qf = np.dot(W,products(G[i:i+chunk,:]-G0).T) + c[:,np.newaxis]
+        pdens += np.sum(np.where(qf < 1.0,U[:,i:i+chunk],0.0),axis=1)
+    if index is None:
+        U = Us[cur]
+    else:
+        U[:,index] = Us[cur]
+    return (U,Ms+G0,Cs,Ps,pdens/fhv)
                                                   
                                         
 def main():
@@ -107,11 +374,27 @@ Usage:
 python %s  [-p "bandPositions"] [-d "spatialDimensions"] 
 [-K number of clusters] [-M max scale][-m min scale] 
 [-t initial annealing temperature] [-s spatial mixing factor] 
-[-P generate class probabilities image] filename
+[-P generate class probabilities image] 
+[-f float32 memberships] [-b mini-batch size] 
+[-n mini-batch steps] [-r random seed] [-j workers] filename
 
 bandPositions and spatialDimensions are lists, 
 e.g., -p [1,2,4] -d [0,0,400,400]  
 
+-f holds the class memberships in single precision,
+   halving the memory needed for large images
+-b clusters all but the finest scale with mini-batch
+   (stochastic) EM on random batches of this many pixels,
+   only the finest scale is clustered with full EM. The
+   spatial factor -s enters a single final smoothing step
+   at the mini-batch scales. Annealing (-t), which only
+   the coarsest scale uses, is then skipped altogether
+-n number of mini-batch steps per scale (default 100)
+-r seeds the random number generator for reproducible
+   results
+-j runs full EM on row blocks of the image in the given
+   number of worker processes (default 1)
+
 If the input file is named 
 
          path/filenbasename.ext then
@@ -124,10 +407,15 @@ and the class probabilities output file is named
 
          path/filebasename_emprobs.ext
 --------------------------------------------------------''' %sys.argv[0]
-    options, args = getopt.getopt(sys.argv[1:],'hp:d:K:M:m:t:s:P')
+    options, args = getopt.getopt(sys.argv[1:],'hp:d:K:M:m:t:s:Pfb:n:r:j:')
     pos = None
     dims = None  
     K,max_scale,min_scale,T0,beta,probs = (None,None,None,None,None,None)        
+    dtype = np.float64
+    batch = None
+    steps = 100
+    seed = None
+    workers = 1
     for option, value in options:
         if option == '-h':
             print usage
@@ -148,6 +436,16 @@ and the class probabilities output file is named
             beta = eval(value) 
         elif option == '-P':
             probs = True                              
+        elif option == '-f':
+            dtype = np.float32
+        elif option == '-b':
+            batch = eval(value)
+        elif option == '-n':
+            steps = eval(value)
+        elif option == '-r':
+            seed = eval(value)
+        elif option == '-j':
+            workers = eval(value)
     if len(args) != 1: 
         print 'Incorrect number of arguments'
         print usage
@@ -168,6 +466,8 @@ and the class probabilities output file is named
         beta = 0.5   
     if probs is None:
         probs = False
+    if seed is not None:
+        np.random.seed(seed)
                                                   
     gdal.AllRegister()
     infile = args[0]
@@ -221,13 +521,16 @@ and the class probabilities output file is named
     G = np.transpose(np.array([DWTbands[i].get_quadrant(0,float=True).ravel() for i in range(bands)]))
 #  initialize membership matrix    
     n = G.shape[0]
-    U = np.random.random((K,n))
+    U = np.random.random((K,n)).astype(dtype)
     den = np.sum(U,axis=0)
     for j in range(K):
         U[j,:] = U[j,:]/den
 #  cluster at minimum scale
     try:
-        U,Ms,Cs,Ps,pdens = em(G,U,T0,beta,rows,cols)
+        if batch and (max_scale > min_scale):
+            U,Ms,Cs,Ps,pdens = em_minibatch(G,U,batch,beta,rows,cols,steps)
+        else:
+            U,Ms,Cs,Ps,pdens = em(G,U,T0,beta,rows,cols,workers=workers)
     except:
         print 'em failed' 
         return     
@@ -236,7 +539,7 @@ and the class probabilities output file is named
     idx = idx[::-1]
     U = U[idx,:]
 #  clustering at increasing scales
-    for i in range(max_scale-min_scale):
+    for scale in range(max_scale-1,min_scale-1,-1):
 #      expand U and renormalize         
         U = np.reshape(U,(K,rows,cols))  
         rows = rows*2
@@ -253,9 +556,13 @@ and the class probabilities output file is named
             DWTbands[i].invert()
         G = np.transpose(np.array([DWTbands[i].get_quadrant(0,float=True).ravel() for i in range(bands)]))  
 #      cluster
-        unfrozen = np.where(np.max(U,axis=0) < 0.90)
         try:
-            U,Ms,Cs,Ps,pdens = em(G,U,0.0,beta,rows,cols,unfrozen=unfrozen)
+            if batch and (scale > min_scale):
+                U,Ms,Cs,Ps,pdens = em_minibatch(G,U,batch,beta,rows,cols,steps)
+            else:
+                unfrozen = np.where(np.max(U,axis=0) < 0.90)
+                U,Ms,Cs,Ps,pdens = em(G,U,0.0,beta,rows,cols,
+                                      unfrozen=unfrozen,workers=workers)
         except:
             print 'em failed' 
             return                         
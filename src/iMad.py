@@ -24,17 +24,300 @@ from scipy import linalg, stats
 from osgeo import gdal
 from osgeo.gdalconst import GA_ReadOnly, GDT_Float32
 import os, sys,time, getopt
+from multiprocessing import Pool
+
+#  tiles shared with forked worker processes
+_tiles = None
+
+def validpixels(tile,bands,nodata=None,mask=False):
+#  boolean mask of pixels valid in both images, a non-zero 
+#  mask band (if present) follows the 2*bands image bands
+    X = tile[:,:2*bands]
+    valid = np.all(np.isfinite(X),axis=1)
+    if nodata is None:
+        valid &= (np.sum(X[:,:bands],axis=1) != 0) \
+               & (np.sum(X[:,bands:],axis=1) != 0)
+    else:
+        valid &= np.all(X != nodata,axis=1)
+    if mask:
+        valid &= (tile[:,2*bands] != 0)
+    return valid
+
+def statistics(blocks,bands,nodata=None,mask=False,transform=None):
+#  provisional means over tiles, weighted by no-change 
+#  probabilities if transform = (A,B,means1,means2,sigMADs)
+    cpm = auxil.Cpm(2*bands)
+    mads = chisqr = None
+    for row,nrows,tile in blocks:
+        tile = tile[validpixels(tile,bands,nodata,mask),:2*bands]
+        if transform is not None:
+#          reuse the output buffers across tiles        
+            n = tile.shape[0]
+            if (mads is None) or (mads.shape[0] < n):
+                mads = np.empty((n,bands))
+                chisqr = np.empty(n)
+            auxil.madtransform(tile,*transform,mads=mads[:n],chisqr=chisqr[:n])
+            wts = 1-stats.chi2.cdf(chisqr[:n],[bands])
+            cpm.update(tile,wts)
+        else:
+            cpm.update(tile)
+    return cpm
+
+def strip_statistics((start,stop,bands,nodata,mask,transform)):
+#  worker: statistics of one row strip of the shared tiles
+    return statistics(_tiles.blocks(start,stop),bands,nodata,mask,transform)
+
+class MadTiles(object):
+    '''Iterator over (row,nrows,mads,chisqr) for the MAD variates
+       and chi-square values of successive multi-row tiles. The
+       image pair and any tile cache are released when the tiles
+       are exhausted, on close() or when the object is collected'''
+    def __init__(self,reader,transform,datasets):
+        self.reader = reader
+        self.transform = transform
+#      referenced here to keep the datasets open        
+        self.datasets = datasets
+
+    def __iter__(self):
+        if self.reader is None:
+            raise ValueError('MAD tiles are closed')
+        try:
+            for row,nrows,tile in self.reader:
+                mads,chisqr = auxil.madtransform(tile,*self.transform)
+                yield (row,nrows,mads,chisqr)
+        finally:
+            self.close()
+
+    def close(self):
+        if self.reader is not None:
+            if hasattr(self.reader,'close'):
+                self.reader.close()
+            self.reader = None
+            self.datasets = None
+
+    def __del__(self):
+        self.close()
+
+def imad(image1,image2,pos=None,dims=None,niter=50,offset2=None,
+         budget=1024,scratch=None,nodata=None,mask=None,workers=1,
+         fraction=None,final=3,ridge=0.0,accelerate=False,verbose=False):
+    '''IR-MAD of two images, given as filenames or GDAL datasets.
+       pos are the band positions, dims = [x0,y0,cols,rows] the
+       spatial subset of image1 and offset2 = (x2,y2) its upper left 
+       corner in image2 (default (x0,y0)). mask is an optional image 
+       (filename or dataset) whose zero pixels in band 1 are excluded
+       and ridge and accelerate regularize and extrapolate the 
+       iteration. The remaining keywords are as for the command 
+       line options.
+       Returns (A,B,means1,means2,sigMADs,rhos,tiles) where rhos holds 
+       the canonical correlations of each iteration and tiles is a
+       MadTiles iterator over (row,nrows,mads,chisqr) for the MAD 
+       variates and chi-square values of successive multi-row tiles.
+       Callers that do not exhaust tiles should call tiles.close()'''
+    datasets = []
+    for image in (image1,image2,mask):
+        if isinstance(image,basestring):
+            image = gdal.Open(image,GA_ReadOnly)
+            if image is None:
+                raise ValueError('Images could not be read')
+        datasets.append(image)
+    inDataset1,inDataset2,maskDataset = datasets
+    cols = inDataset1.RasterXSize
+    rows = inDataset1.RasterYSize    
+    bands = inDataset1.RasterCount
+    if bands != inDataset2.RasterCount:
+        raise ValueError('Size mismatch')
+    if pos is None:
+        pos = range(1,bands+1) 
+    else:
+        bands = len(pos) 
+    if dims is None:
+        x0 = 0
+        y0 = 0
+    else:
+        x0,y0,cols,rows = dims    
+    if offset2 is None:
+        x2 = x0
+        y2 = y0
+    else:
+        x2,y2 = offset2
+#  iteration of MAD    
+    delta = 1.0
+    oldrho = np.zeros(bands)     
+    itr = 0
+    transform = None
+    rasterBands1 = []
+    rasterBands2 = [] 
+    rhos = np.zeros((niter,bands))
+    for b in pos:
+        rasterBands1.append(inDataset1.GetRasterBand(b)) 
+    for b in pos:
+        rasterBands2.append(inDataset2.GetRasterBand(b))  
+#  multi-row, all-band tiles of both images, mask band last       
+    rasterBands = rasterBands1+rasterBands2
+    offsets = [(x0,y0)]*bands+[(x2,y2)]*bands
+    if maskDataset is not None:
+        rasterBands.append(maskDataset.GetRasterBand(1))
+        offsets.append((x0,y0))
+    masked = maskDataset is not None
+    reader = auxil.BlockReader(rasterBands,offsets,cols,rows)  
+#  decode the pair once and reuse it on every iteration       
+    if niter > 1:
+        reader = auxil.BlockCache(reader,budget*2**20,scratch)
+        if verbose and (reader.scratch is not None):
+            print 'image pair cached in: '+reader.scratch                
+    pool = None
+    try:
+#      workers are forked after caching and share the tiles         
+        if (workers > 1) and (niter > 1):
+            global _tiles
+            _tiles = reader
+            strips = auxil.rowstrips(rows,reader.nrows,workers)
+            pool = Pool(len(strips))
+#      warm start on a stratified subsample of the pixels        
+        blocks = reader
+        switch = 0
+        minitr = 0
+        if (fraction is not None) and (niter > final):
+            blocks = [(0,0,np.concatenate([tile[auxil.stratified(nrows,cols,fraction)] 
+                                           for row,nrows,tile in reader]))]
+            if verbose:
+                print 'warm start on %i subsampled pixels'%blocks[0][2].shape[0]
+        history = []
+        while ((delta > 0.001) or (itr < minitr)) and (itr < niter):   
+#          spectral tiling for statistics
+            if (pool is None) or (blocks is not reader):
+                cpm = statistics(blocks,bands,nodata,masked,transform)
+            else:
+                cpms = pool.map(strip_statistics,[(r0,r1,bands,nodata,
+                                     masked,transform) for r0,r1 in strips])
+                cpm = cpms[0]
+                for other in cpms[1:]:
+                    cpm.merge(other)               
+#         weighted covariance matrices and means 
+            S = cpm.covariance() 
+            means = cpm.means()    
+            if accelerate:
+#              extrapolate from three successive iterates, 
+#              provided the result is positive definite            
+                history.append(np.append(means,np.ravel(S)))
+                if len(history) == 3:
+                    x = auxil.extrapolate(*history)
+                    Sx = np.mat(np.reshape(x[2*bands:],(2*bands,2*bands)))
+                    try:
+                        np.linalg.cholesky(Sx)
+                        S = Sx
+                        means = x[:2*bands]
+                    except np.linalg.LinAlgError:
+                        pass
+                    history = [np.append(means,np.ravel(S))]
+            s11 = S[0:bands,0:bands]
+            s22 = S[bands:,bands:] 
+            if ridge > 0:
+                s11 = s11 + ridge*np.mean(np.diag(s11))*np.eye(bands)
+                s22 = s22 + ridge*np.mean(np.diag(s22))*np.eye(bands)
+            s12 = S[0:bands,bands:]
+            s21 = S[bands:,0:bands]        
+            c1 = s12*linalg.inv(s22)*s21 
+            b1 = s11
+            c2 = s21*linalg.inv(s11)*s12
+            b2 = s22
+#         solution of generalized eigenproblems 
+            if bands>1:
+#              both problems in one batch, eigenvalues sorted        
+                mu2s,Vs = auxil.geneiv(np.array([c1,c2]),np.array([b1,b2]))
+                A = np.mat(Vs[0])
+                B = np.mat(Vs[1])
+                mu2 = mu2s[1]
+            else:
+                mu2 = c1/b1
+                A = 1/np.sqrt(b1)
+                B = 1/np.sqrt(b2)   
+#          canonical correlations             
+            rho = np.sqrt(mu2)
+            b2 = np.diag(B.T*B)
+            sigma = np.sqrt( 2*(1-rho ) )
+#          stopping criterion
+            delta = max(abs(rho-oldrho))
+            rhos[itr,:] = rho
+            oldrho = rho  
+#          sigmas and means, broadcast over tiles             
+            sigMADs = sigma 
+            means1 = means[0:bands] 
+            means2 = means[bands::]
+#          ensure sum of positive correlations between X and U is positive
+            D = np.diag(1/np.sqrt(np.diag(s11)))
+            s = np.ravel(np.sum(D*s11*A,axis=0)) 
+            A = A*np.diag(s/np.abs(s))          
+#          ensure positive correlation between each pair of canonical variates        
+            cov = np.diag(A.T*s12*B)    
+            B = B*np.diag(cov/np.abs(cov))          
+            transform = (A,B,means1,means2,sigMADs)
+            itr += 1  
+            if (blocks is not reader) and ((delta <= 0.001) or (itr >= niter-final)):
+#              switch to the full image, iterating there at least final
+#              times and until convergence        
+                blocks = reader
+                switch = itr
+                minitr = itr+final
+                delta = 1.0
+                history = []             
+    except:
+#      remove the cache (and any scratch file) of a failed run        
+        if niter > 1:
+            reader.close()
+        raise
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    if verbose and (switch > 0):
+        print 'rho trajectory, subsample (%i iterations):'%switch
+        for i in range(switch):
+            print '  %s'%str(rhos[i,:])
+        print 'rho trajectory, full image (%i iterations):'%(itr-switch)
+        for i in range(switch,itr):
+            print '  %s'%str(rhos[i,:])
+
+    return (A,B,means1,means2,sigMADs,rhos[0:itr,:],
+            MadTiles(reader,transform,datasets))
 
 def main():   
     usage = '''
 Usage:
 -----------------------------------------------------
 python %s [-h] [-n] [-i max iterations] [-p bandPositions] 
-[-d spatialDimensions] filename1 filename2
+[-d spatialDimensions] [-m memory budget] [-t scratch directory] 
+[-v no-data value] [-k maskfile] [-j workers] 
+[-s subsample fraction] [-f final iterations] [-c] 
+[-r ridge] [-a] filename1 filename2
 -----------------------------------------------------
 bandPositions and spatialDimensions are lists, 
 e.g., -p [1,2,3] -d [0,0,400,400]
 -n stops any graphics output
+-m is the memory (MB, default 1024) for caching the
+   image pair across iterations. Larger pairs are
+   cached in a scratch file in the -t directory
+   (default: system temporary directory)
+-v excludes pixels having the no-data value in any band
+   of either image (default: excludes pixels whose band
+   sum is zero in either image)
+-k excludes pixels which are zero in band 1 of maskfile,
+   an image with the same spatial dimensions as filename1
+-j runs each iteration on row strips in the given number
+   of worker processes (default 1)
+-s runs the early iterations on a spatially stratified
+   random subsample of the given fraction of the pixels
+   and then iterates on the full image at least -f times
+   (default 3) and until convergence
+-c writes tiled, DEFLATE-compressed GeoTIFF output
+   (if filename1 is a GeoTIFF)
+-r adds ridge times the mean band variance to the 
+   diagonals of the within-image covariance matrices
+   (default 0.0), for near-singular band sets
+-a accelerates convergence by squared Aitken (SQUAREM) 
+   extrapolation of the weighted means and covariances 
+   every third iteration
 -----------------------------------------------------
 The output MAD variate file is has the same format
 as filename1 and is named
@@ -46,10 +329,20 @@ where filename1 = path/filebasename1.ext1
 
 For ENVI files, ext1 or ext2 is the empty string.       
 -----------------------------------------------------''' %sys.argv[0]
-    options, args = getopt.getopt(sys.argv[1:],'hnp:i:d:')
+    options, args = getopt.getopt(sys.argv[1:],'hnp:i:d:m:t:v:k:j:s:f:cr:a')
     pos = None
     dims = None  
     niter = 50  
+    budget = 1024
+    scratch = None
+    nodata = None
+    maskfn = None
+    workers = 1
+    fraction = None
+    final = 3
+    compress = False
+    ridge = 0.0
+    accelerate = False
     graphics = True        
     for option, value in options:
         if option == '-h':
@@ -63,6 +356,26 @@ For ENVI files, ext1 or ext2 is the empty string.
             dims = eval(value) 
         elif option == '-i':
             niter = eval(value)
+        elif option == '-m':
+            budget = eval(value)
+        elif option == '-t':
+            scratch = value
+        elif option == '-v':
+            nodata = eval(value)
+        elif option == '-k':
+            maskfn = value
+        elif option == '-j':
+            workers = eval(value)
+        elif option == '-s':
+            fraction = eval(value)
+        elif option == '-f':
+            final = eval(value)
+        elif option == '-c':
+            compress = True
+        elif option == '-r':
+            ridge = eval(value)
+        elif option == '-a':
+            accelerate = True
     if len(args) != 2:
         print 'Incorrect number of arguments'
         print usage
@@ -82,8 +395,6 @@ For ENVI files, ext1 or ext2 is the empty string.
         cols = inDataset1.RasterXSize
         rows = inDataset1.RasterYSize    
         bands = inDataset1.RasterCount
-        cols2 = inDataset2.RasterXSize
-        rows2 = inDataset2.RasterYSize    
         bands2 = inDataset2.RasterCount
     except Exception as e:
         print 'Error: %s  --Images could not be read.'%e
@@ -91,9 +402,7 @@ For ENVI files, ext1 or ext2 is the empty string.
     if bands != bands2:
         sys.stderr.write("Size mismatch")
         sys.exit(1)                
-    if pos is None:
-        pos = range(1,bands+1) 
-    else:
+    if pos is not None:
         bands = len(pos) 
     if dims is None:
         x0 = 0
@@ -102,106 +411,28 @@ For ENVI files, ext1 or ext2 is the empty string.
         x0,y0,cols,rows = dims    
 # if second image is warped, assume it has same dimensions as dims        
     if root2.find('_warp') != -1:
-        x2 = 0
-        y2 = 0   
+        offset2 = (0,0)
     else:
-        x2 = x0
-        y2 = y0    
+        offset2 = None    
     print '------------IRMAD -------------'
     print time.asctime()     
     print 'time1: '+fn1
     print 'time2: '+fn2   
     start = time.time()
-#  iteration of MAD    
-    cpm = auxil.Cpm(2*bands)    
-    delta = 1.0
-    oldrho = np.zeros(bands)     
-    itr = 0
-    tile = np.zeros((cols,2*bands))
-    sigMADs = 0 
-    means1 = 0
-    means2 = 0
-    A = 0
-    B = 0
-    rasterBands1 = []
-    rasterBands2 = [] 
-    rhos = np.zeros((niter,bands))
-    for b in pos:
-        rasterBands1.append(inDataset1.GetRasterBand(b)) 
-    for b in pos:
-        rasterBands2.append(inDataset2.GetRasterBand(b))                    
-    while (delta > 0.001) and (itr < niter):   
-#      spectral tiling for statistics
-        for row in range(rows):
-            for k in range(bands):
-                tile[:,k] = rasterBands1[k].ReadAsArray(x0,y0+row,cols,1)
-                tile[:,bands+k] = rasterBands2[k].ReadAsArray(x2,y2+row,cols,1)
-#          eliminate no-data pixels    
-            tile = np.nan_to_num(tile)              
-            tst1 = np.sum(tile[:,0:bands],axis=1) 
-            tst2 = np.sum(tile[:,bands::],axis=1) 
-            idx1 = set(np.where(  (tst1 != 0)  )[0]) 
-            idx2 = set(np.where(  (tst2 != 0)  )[0]) 
-            idx = list(idx1.intersection(idx2))   
-            if itr>0:
-                mads = np.asarray((tile[:,0:bands]-means1)*A - (tile[:,bands::]-means2)*B)
-                chisqr = np.sum((mads/sigMADs)**2,axis=1)
-                wts = 1-stats.chi2.cdf(chisqr,[bands])
-                cpm.update(tile[idx,:],wts[idx])
-            else:
-                cpm.update(tile[idx,:])               
-#     weighted covariance matrices and means 
-        S = cpm.covariance() 
-        means = cpm.means()    
-#     reset prov means object           
-        cpm.__init__(2*bands)  
-        s11 = S[0:bands,0:bands]
-        s22 = S[bands:,bands:] 
-        s12 = S[0:bands,bands:]
-        s21 = S[bands:,0:bands]        
-        c1 = s12*linalg.inv(s22)*s21 
-        b1 = s11
-        c2 = s21*linalg.inv(s11)*s12
-        b2 = s22
-#     solution of generalized eigenproblems 
-        if bands>1:
-            mu2a,A = auxil.geneiv(c1,b1)                
-            mu2b,B = auxil.geneiv(c2,b2)               
-#          sort a   
-            idx = np.argsort(mu2a)      
-            A = A[:,idx]        
-#          sort b   
-            idx = np.argsort(mu2b)
-            B = B[:,idx] 
-            mu2 = mu2b[idx]
-        else:
-            mu2 = c1/b1
-            A = 1/np.sqrt(b1)
-            B = 1/np.sqrt(b2)   
-#      canonical correlations             
-        rho = np.sqrt(mu2)
-        b2 = np.diag(B.T*B)
-        sigma = np.sqrt( 2*(1-rho ) )
-#      stopping criterion
-        delta = max(abs(rho-oldrho))
-        rhos[itr,:] = rho
-        oldrho = rho  
-#      tile the sigmas and means             
-        sigMADs = np.tile(sigma,(cols,1)) 
-        means1 = np.tile(means[0:bands],(cols,1)) 
-        means2 = np.tile(means[bands::],(cols,1))
-#      ensure sum of positive correlations between X and U is positive
-        D = np.diag(1/np.sqrt(np.diag(s11)))
-        s = np.ravel(np.sum(D*s11*A,axis=0)) 
-        A = A*np.diag(s/np.abs(s))          
-#      ensure positive correlation between each pair of canonical variates        
-        cov = np.diag(A.T*s12*B)    
-        B = B*np.diag(cov/np.abs(cov))          
-        itr += 1              
-    print 'rho: %s'%str(rho)          
+    A,B,means1,means2,sigMADs,rhos,tiles = imad(inDataset1,inDataset2,
+                  pos=pos,dims=dims,niter=niter,offset2=offset2,
+                  budget=budget,scratch=scratch,nodata=nodata,mask=maskfn,
+                  workers=workers,fraction=fraction,final=final,
+                  ridge=ridge,accelerate=accelerate,verbose=True)
+    itr = rhos.shape[0]
+    print 'rho: %s'%str(rhos[-1,:])          
 # write results to disk
     driver = inDataset1.GetDriver()    
-    outDataset = driver.Create(outfn,cols,rows,bands+1,GDT_Float32)
+    if compress:
+        options = auxil.createoptions(driver)
+    else:
+        options = []
+    outDataset = driver.Create(outfn,cols,rows,bands+1,GDT_Float32,options)
     projection = inDataset1.GetProjection()
     geotransform = inDataset1.GetGeoTransform()
     if geotransform is not None:
@@ -211,20 +442,10 @@ For ENVI files, ext1 or ext2 is the empty string.
         outDataset.SetGeoTransform(tuple(gt))
     if projection is not None:
         outDataset.SetProjection(projection)            
-    outBands = [] 
-    for k in range(bands+1):
-        outBands.append(outDataset.GetRasterBand(k+1))   
-    for row in range(rows):
-        for k in range(bands):
-            tile[:,k] = rasterBands1[k].ReadAsArray(x0,y0+row,cols,1)
-            tile[:,bands+k] = rasterBands2[k].ReadAsArray(x2,y2+row,cols,1)       
-        mads = np.asarray((tile[:,0:bands]-means1)*A - (tile[:,bands::]-means2)*B)
-        chisqr = np.sum((mads/sigMADs)**2,axis=1) 
-        for k in range(bands):
-            outBands[k].WriteArray(np.reshape(mads[:,k],(1,cols)),0,row)
-        outBands[bands].WriteArray(np.reshape(chisqr,(1,cols)),0,row)                        
-    for outBand in outBands: 
-        outBand.FlushCache()
+    writer = auxil.BlockWriter(outDataset)
+    for row,nrows,mads,chisqr in tiles:
+        writer.write(np.column_stack((mads,chisqr)))
+    writer.close()
     outDataset = None
     inDataset1 = None
     inDataset2 = None  
@@ -238,4 +459,3 @@ For ENVI files, ext1 or ext2 is the empty string.
     
 if __name__ == '__main__':
     main()
-    
\ No newline at end of file
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+#******************************************************************************
+#  Name:     normalize.py
+#  Purpose:  Automatic relative radiometric normalization: image-image
+#            registration, IR-MAD and radcal in one process, for one
+#            or a time series of target images
+#  Usage:
+#    python normalize.py -h
+#
+#  Copyright (c) 2013, Mort Canty
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+import auxil.auxil as auxil
+import numpy as np
+from osgeo import gdal
+from osgeo.gdalconst import GA_ReadOnly, GDT_Float32
+import os, sys, time, getopt
+from multiprocessing import Pool
+from register import register
+from iMad import imad
+from radcal import nochange, radcal, normalize
+
+#  reference image shared with forked worker processes
+_reference = None
+
+def reference(fn1,warpband=1,dims=None):
+    '''Read the spatial subset dims of reference image fn1 once
+       into a MEM dataset and precompute the Fourier spectra of
+       its band warpband for registration.
+       Returns (fn1,dataset,ref)'''
+    inDataset1 = gdal.Open(fn1,GA_ReadOnly)
+    if inDataset1 is None:
+        raise ValueError('Image could not be read')
+    cols = inDataset1.RasterXSize
+    rows = inDataset1.RasterYSize
+    bands = inDataset1.RasterCount
+    if dims is None:
+        x0 = 0
+        y0 = 0
+    else:
+        x0,y0,cols,rows = dims
+    driver = gdal.GetDriverByName('MEM')
+    refDataset = driver.Create('',cols,rows,bands,
+                               inDataset1.GetRasterBand(1).DataType)
+    projection = inDataset1.GetProjection()
+    geotransform = inDataset1.GetGeoTransform()
+    if geotransform is not None:
+        gt = list(geotransform)
+        gt[0] = gt[0] + x0*gt[1]
+        gt[3] = gt[3] + y0*gt[5]
+        refDataset.SetGeoTransform(tuple(gt))
+    if projection is not None:
+        refDataset.SetProjection(projection)
+    for k in range(bands):
+        refDataset.GetRasterBand(k+1).WriteArray(
+            inDataset1.GetRasterBand(k+1).ReadAsArray(x0,y0,cols,rows))
+    refband = refDataset.GetRasterBand(warpband).ReadAsArray().astype(np.float32)
+    return (fn1,refDataset,auxil.similarityref(refband))
+
+def pipeline(fn1,fn2,pos=None,dims=None,warpband=1,niter=50,ncpThresh=0.95,
+             maxpixels=100000,workers=4,keep=False,vrt=False,ref=None,
+             verbose=False):
+    '''Normalize target image fn2 to reference image fn1: register,
+       IR-MAD and radcal, with the warped target and the MAD variates
+       held in memory (written too if keep is set). ref is an optional
+       reference(fn1,warpband,dims). The remaining keywords are as for
+       the command line options.
+       Returns (outfn,rho,aa,bb,Pt,Pf,count) with the canonical
+       correlations, intercepts, slopes, test probabilities and the
+       number of no-change pixels found'''
+    if ref is None:
+        ref = reference(fn1,warpband,dims)
+    fn1,refDataset,simref = ref
+    bands = refDataset.RasterCount
+    cols = refDataset.RasterXSize
+    rows = refDataset.RasterYSize
+    if pos is None:
+        pos = range(1,bands+1)
+    bands = len(pos)
+    path1 = os.path.dirname(fn1)
+    root1, ext1 = os.path.splitext(os.path.basename(fn1))
+    path2 = os.path.dirname(fn2)
+    root2, ext2 = os.path.splitext(os.path.basename(fn2))
+    warpfn = path2 + '/' + root2 + '_warp' + ext2
+    madfn = path1 + '/' + 'MAD(%s-%s)%s'%(root1,root2+'_warp'+ext2,ext1)
+    outfn = path2 + '/' + root2 + '_warp_norm' + ext2
+    if vrt:
+        ext2 = '.vrt'
+    fsoutfn = path2 + '/' + root2 + '_norm_all' + ext2
+    inDataset2 = gdal.Open(fn2,GA_ReadOnly)
+    if inDataset2 is None:
+        raise ValueError('Image could not be read')
+    start = time.time()
+#  register, the warped target is trimmed to dims
+    if keep:
+        warpDataset,_ = register(fn1,inDataset2,warpband,dims,warpfn,ref=simref)
+        if verbose:
+            print 'warped image written to: '+warpfn
+    else:
+        warpDataset,_ = register(fn1,inDataset2,warpband,dims,ref=simref)
+    if verbose:
+        print 'registered: %s'%str(time.time()-start)
+#  IR-MAD on the reference subset
+    A,B,means1,means2,sigMADs,rhos,tiles = imad(refDataset,warpDataset,
+                  pos=pos,niter=niter,offset2=(0,0))
+    if verbose:
+        print 'IR-MAD iterations: %i'%rhos.shape[0]
+        print 'rho: %s'%str(rhos[-1,:])
+    writer = None
+    if keep:
+        driver = gdal.Open(fn1,GA_ReadOnly).GetDriver()
+        madDataset = driver.Create(madfn,cols,rows,bands+1,GDT_Float32)
+        geotransform = refDataset.GetGeoTransform()
+        projection = refDataset.GetProjection()
+        if geotransform is not None:
+            madDataset.SetGeoTransform(geotransform)
+        if projection is not None:
+            madDataset.SetProjection(projection)
+        writer = auxil.BlockWriter(madDataset)
+#  the MAD variates are consumed as they are generated
+    def chisqrs():
+        for row,nrows,mads,chisqr in tiles:
+            if writer is not None:
+                writer.write(np.column_stack((mads,chisqr)))
+            yield (row,nrows,chisqr)
+    try:
+        idx,count = nochange(chisqrs(),bands,ncpThresh,maxpixels)
+    finally:
+        tiles.close()
+    if writer is not None:
+        writer.close()
+        madDataset = None
+        if verbose:
+            print 'MAD variates written to: '+madfn
+    if verbose:
+        print 'no-change pixels found: %i'%count
+#  radiometric normalization
+    aa,bb,R,Pt,Pf,_ = radcal(refDataset,warpDataset,idx,pos)
+    if verbose:
+        for j in range(bands):
+            print 'band: %i  slope: %f  intercept: %f  corr: %f  P(t-test): %f  P(F-test): %f' \
+                                  %(pos[j],bb[j],aa[j],R[j],Pt[j],Pf[j])
+    if keep:
+        warpDataset.FlushCache()
+        warpDataset = None
+        normalize(warpfn,outfn,aa,bb,pos,workers=workers)
+    else:
+        normalize(warpDataset,outfn,aa,bb,pos,driver=inDataset2.GetDriver())
+        warpDataset = None
+    if verbose:
+        print 'result written to: '+outfn
+    if dims is not None:
+        normalize(fn2,fsoutfn,aa,bb,pos,workers=workers,vrt=vrt)
+        if verbose:
+            print 'full result written to: '+fsoutfn
+    inDataset2 = None
+    return (outfn,rhos[-1,:],aa,bb,Pt,Pf,count)
+
+def pipeline_target((fn2,kwargs)):
+#  normalize one target against the shared reference in a worker process
+    try:
+        return (fn2,pipeline(_reference[0],fn2,ref=_reference,**kwargs))
+    except Exception as e:
+        return (fn2,'Error: %s'%e)
+
+def main():
+    usage = '''
+Usage:
+-----------------------------------------------------
+python %s [-h] [-b warpband] [-p bandPositions]
+[-d spatialDimensions] [-i max iterations]
+[-t no-change prob threshold] [-m max no-change pixels]
+[-j threads] [-w processes] [-k] [-v]
+reffname targetfname [targetfname ...]
+-----------------------------------------------------
+Registers each target image to the reference image,
+runs IR-MAD on the pair and normalizes the target to
+the reference with the no-change pixels, all in one
+process. The warped target and the MAD variates are
+held in memory and only the normalized target
+
+      path2/targetbasename_warp_norm.ext2
+
+is written. If a spatial subset is given, the full
+target scene is normalized as well:
+
+      path2/targetbasename_norm_all.ext2
+
+For a time series of targets the reference is read
+and its spectra for registration computed only once.
+The targets are normalized concurrently in -w worker
+processes (default 4) and a summary table of the
+canonical correlations, gains, offsets and test
+probabilities is printed.
+
+bandPositions and spatialDimensions are lists,
+e.g., -p [1,2,3] -d [0,0,400,400]
+-b band used for registration (default 1)
+-i IR-MAD iterations (default 50)
+-t, -m, -j and -v are as for radcal.py
+-k keeps the intermediate warped target and MAD files
+
+      path2/targetbasename_warp.ext2
+      path1/MAD(refbasename-targetbasename_warp.ext2).ext1
+-----------------------------------------------------''' %sys.argv[0]
+    options, args = getopt.getopt(sys.argv[1:],'hb:p:d:i:t:m:j:w:kv')
+    warpband = 1
+    pos = None
+    dims = None
+    niter = 50
+    ncpThresh = 0.95
+    maxpixels = 100000
+    workers = 4
+    processes = 4
+    keep = False
+    vrt = False
+    for option, value in options:
+        if option == '-h':
+            print usage
+            return
+        elif option == '-b':
+            warpband = eval(value)
+        elif option == '-p':
+            pos = eval(value)
+        elif option == '-d':
+            dims = eval(value)
+        elif option == '-i':
+            niter = eval(value)
+        elif option == '-t':
+            ncpThresh = eval(value)
+        elif option == '-m':
+            maxpixels = eval(value)
+        elif option == '-j':
+            workers = eval(value)
+        elif option == '-w':
+            processes = eval(value)
+        elif option == '-k':
+            keep = True
+        elif option == '-v':
+            vrt = True
+    if len(args) < 2:
+        print 'Incorrect number of arguments'
+        print usage
+        sys.exit(1)
+    gdal.AllRegister()
+    fn1 = args[0]  # reference
+    fns = args[1:] # targets
+    print '--------------------------------------------'
+    print 'Automatic relative radiometric normalization'
+    print '--------------------------------------------'
+    print time.asctime()
+    print 'reference image: '+fn1
+    print 'target images: %i'%len(fns)
+    print 'warp band: %i'%warpband
+    start = time.time()
+    global _reference
+    try:
+        _reference = reference(fn1,warpband,dims)
+    except Exception as e:
+        print 'Error: %s  --Image could not be read.'%e
+        sys.exit(1)
+    if pos is None:
+        pos = range(1,_reference[1].RasterCount+1)
+    kwargs = dict(pos=pos,dims=dims,warpband=warpband,niter=niter,
+                  ncpThresh=ncpThresh,maxpixels=maxpixels,workers=workers,
+                  keep=keep,vrt=vrt,verbose=len(fns)==1)
+    jobs = [(fn2,kwargs) for fn2 in fns]
+    if (processes > 1) and (len(fns) > 1):
+#      workers are forked after reading the reference and share it
+        pool = Pool(min(processes,len(fns)))
+        results = pool.map(pipeline_target,jobs)
+        pool.close()
+        pool.join()
+    else:
+        results = map(pipeline_target,jobs)
+#  summary table
+    print '--------------------------------------------'
+    print '%-30s %4s %8s %10s %10s %8s %8s'%('target','band','rho',
+                                   'gain','offset','P(t)','P(F)')
+    for fn2,result in results:
+        if isinstance(result,basestring):
+            print '%-30s %s'%(os.path.basename(fn2),result)
+            continue
+        outfn,rho,aa,bb,Pt,Pf,count = result
+        for j in range(len(pos)):
+            print '%-30s %4i %8.5f %10.6f %10.4f %8.4f %8.4f' \
+                %(os.path.basename(fn2),pos[j],rho[j],bb[j],aa[j],Pt[j],Pf[j])
+    print '--------------------------------------------'
+    print 'elapsed time: %s'%str(time.time()-start)
+
+if __name__ == '__main__':
+    main()
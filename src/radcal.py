@@ -3,7 +3,7 @@
 #  Name:     radcal.py
 #  Purpose:  Automatic radiometric normalization
 #  Usage:             
-#       python radcal.py  [-p 'bandPositions' -d 'spatialDimensions' -t NoChangeProbThresh] imadFile [FullSceneFile] 
+#       python radcal.py  [-p 'bandPositions' -d 'spatialDimensions' -t NoChangeProbThresh -m maxPixels] imadFile [FullSceneFile] 
 #
 #  Copyright (c) 2011, Mort Canty
 #    This program is free software; you can redistribute it and/or modify
@@ -16,25 +16,222 @@
 #    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 #    GNU General Public License for more details.
 
-import sys, os, time, getopt
+import sys, os, time, getopt, threading
+from xml.sax.saxutils import escape
 from numpy import *
 from scipy import stats
 from osgeo import gdal
 import matplotlib.pyplot as plt
 from osgeo.gdalconst import GA_ReadOnly, GDT_Float32
-from auxil.auxil import orthoregress
+from auxil.auxil import orthoregress_many, BlockReader, BlockWriter, \
+                        Reservoir, blockrows, createoptions, imapordered
 
+class Normalizer(object):
+    '''Applies gains bb and offsets aa to row blocks of bands
+       pos of image, which is read from the upper left corner 
+       (x0,y0). Called from a thread pool: if image is a filename,
+       each thread reads through its own dataset handle'''
+    def __init__(self,image,pos,aa,bb,x0,y0,cols,rows,nrows):
+        self.image = image
+        self.pos = pos
+        self.aa = aa
+        self.bb = bb
+        self.offset = (x0,y0)
+        self.cols = cols
+        self.rows = rows
+        self.nrows = nrows
+        self.local = threading.local()
+        
+    def __call__(self,row):
+        reader = getattr(self.local,'reader',None)
+        if reader is None:
+            if isinstance(self.image,basestring):
+                self.local.dataset = gdal.Open(self.image,GA_ReadOnly)
+            else:
+                self.local.dataset = self.image
+            rasterBands = [self.local.dataset.GetRasterBand(k) for k in self.pos]
+            reader = BlockReader(rasterBands,[self.offset]*len(self.pos),
+                                 self.cols,self.rows,self.nrows)
+            self.local.reader = reader
+        nrows = min(self.nrows,self.rows-row)
+        return (self.aa+self.bb*reader.read(row,nrows)).astype(float32)
+    
+def writevrt(vrtfn,fn,pos,aa,bb,cols,rows,projection=None,geotransform=None,
+             offset=(0,0)):
+    '''Write a VRT which normalizes bands pos of image fn, from 
+       upper left corner offset on, with per-band ScaleRatio bb 
+       and ScaleOffset aa'''
+    lines = ['<VRTDataset rasterXSize="%i" rasterYSize="%i">'%(cols,rows)]
+    if projection:
+        lines.append('  <SRS>%s</SRS>'%escape(projection))
+    if geotransform is not None:
+        lines.append('  <GeoTransform>%s</GeoTransform>'
+                     %', '.join([repr(float(g)) for g in geotransform]))
+    for j,k in enumerate(pos):
+        lines += ['  <VRTRasterBand dataType="Float32" band="%i">'%(j+1),
+                  '    <ComplexSource>',
+                  '      <SourceFilename relativeToVRT="0">%s</SourceFilename>'
+                                                 %escape(os.path.abspath(fn)),
+                  '      <SourceBand>%i</SourceBand>'%k,
+                  '      <SrcRect xOff="%i" yOff="%i" xSize="%i" ySize="%i"/>'
+                                                 %(offset[0],offset[1],cols,rows),
+                  '      <DstRect xOff="0" yOff="0" xSize="%i" ySize="%i"/>'
+                                                 %(cols,rows),
+                  '      <ScaleOffset>%r</ScaleOffset>'%float(aa[j]),
+                  '      <ScaleRatio>%r</ScaleRatio>'%float(bb[j]),
+                  '    </ComplexSource>',
+                  '  </VRTRasterBand>']
+    lines.append('</VRTDataset>')
+    f = open(vrtfn,'w')
+    f.write('\n'.join(lines)+'\n')
+    f.close()
+    
+def nochange(blocks,dof,ncpThresh=0.95,maxpixels=100000):
+    '''Uniform random sample of at most maxpixels of the pixels 
+       whose no-change probability exceeds ncpThresh. blocks 
+       iterates over (row,nrows,chisqr) for the chi-square values
+       (dof degrees of freedom) of successive multi-row tiles.
+       Returns the sorted pixel indices and the number of 
+       no-change pixels found'''
+    reservoir = Reservoir(maxpixels)
+    for row,nrows,chisqr in blocks:
+        cols = len(chisqr)//nrows
+        ncp = 1 - stats.chi2.cdf(chisqr,[dof])
+        reservoir.update(where(ncp>ncpThresh)[0]+row*cols)
+    return (sort(reservoir.sample()),reservoir.count)
+    
+def radcal(reference,target,idx,pos=None,dims=None,offset2=None):
+    '''Orthogonal regression of bands pos of target on those of
+       reference (filenames or GDAL datasets) over the no-change 
+       pixels idx of the spatial subset dims = [x0,y0,cols,rows].
+       offset2 is the upper left corner of the subset in target 
+       (default (x0,y0)). Two thirds of the pixels are used for 
+       the regression, the rest to test for equal means (t-test)
+       and variances (F-test) after normalization. 
+       Returns (aa,bb,R,Pt,Pf,XYtrain) with intercepts, slopes,
+       correlations and test probabilities per band, and the
+       (reference,target) training pixels'''
+    datasets = []
+    for image in (reference,target):
+        if isinstance(image,basestring):
+            image = gdal.Open(image,GA_ReadOnly)
+            if image is None:
+                raise ValueError('Images could not be read')
+        datasets.append(image)
+    referenceDataset,targetDataset = datasets
+    if pos is None:
+        pos = range(1,referenceDataset.RasterCount+1)      
+    if dims is None:
+        x0 = 0; y0 = 0
+        cols = referenceDataset.RasterXSize
+        rows = referenceDataset.RasterYSize
+    else:
+        x0,y0,cols,rows = dims   
+    if offset2 is None:
+        offset2 = (x0,y0)       
+    bands = len(pos)
+    m = len(idx)
+#  gather the no-change pixels from reference and target bands    
+    rasterBands = [referenceDataset.GetRasterBand(k) for k in pos] \
+                + [targetDataset.GetRasterBand(k) for k in pos]
+    offsets = [(x0,y0)]*bands + [offset2]*bands            
+    XY = zeros((m,2*bands))
+    for row,nrows,tile in BlockReader(rasterBands,offsets,cols,rows):
+        i0,i1 = searchsorted(idx,[row*cols,(row+nrows)*cols])
+        XY[i0:i1,:] = tile[idx[i0:i1]-row*cols,:]
+    XY = XY[random.permutation(m),:]
+    XYtrain = XY[0:2*m//3,:]
+    XYtest = XY[2*m//3:,:]
+    mtest = XYtest.shape[0]
+#  regress all bands at once    
+    bb,aa,R = orthoregress_many(XYtrain[:,bands:],XYtrain[:,:bands])
+#  t-test for equal means, F-test for equal variances
+    X = XYtest[:,:bands]
+    Y = aa + bb*XYtest[:,bands:]
+    _,Pt = stats.ttest_ind(X,Y,axis=0)
+    f = var(X,axis=0)/var(Y,axis=0)
+    f = where(f<1.0,1/f,f)
+    Pf = stats.f.sf(f,mtest-1,mtest-1)
+    return (aa,bb,R,Pt,Pf,XYtrain)
+    
+def normalize(image,outfn,aa,bb,pos=None,dims=None,driver=None,
+              workers=4,vrt=False):
+    '''Normalize bands pos of image (filename or GDAL dataset) in
+       the spatial subset dims with intercepts aa and slopes bb and
+       write the result to outfn with the given driver (default 
+       that of image), tiled and compressed if GeoTIFF. Row blocks
+       are normalized in workers threads, each reading through its
+       own handle if image is a filename. If vrt is set, outfn is
+       instead a VRT applying the normalization on the fly'''
+    fn = None
+    if isinstance(image,basestring):
+        fn = image
+        image = gdal.Open(fn,GA_ReadOnly)
+        if image is None:
+            raise ValueError('Image could not be read')
+    if pos is None:
+        pos = range(1,image.RasterCount+1)
+    if dims is None:
+        x0 = 0; y0 = 0
+        cols = image.RasterXSize
+        rows = image.RasterYSize
+    else:
+        x0,y0,cols,rows = dims
+    projection = image.GetProjection()
+    geotransform = image.GetGeoTransform()
+    if geotransform is not None:
+        gt = list(geotransform)
+        gt[0] = gt[0] + x0*gt[1]
+        gt[3] = gt[3] + y0*gt[5]
+        geotransform = tuple(gt)
+    if vrt:
+        if fn is None:
+            raise ValueError('VRT output needs an image file')
+        writevrt(outfn,fn,pos,aa,bb,cols,rows,projection,geotransform,(x0,y0))
+        return
+    if driver is None:
+        driver = image.GetDriver()
+    outDataset = driver.Create(outfn,cols,rows,len(pos),GDT_Float32,
+                               createoptions(driver))
+    if geotransform is not None:
+        outDataset.SetGeoTransform(geotransform)
+    if projection is not None:
+        outDataset.SetProjection(projection) 
+#  threads normalize blocks of rows, written in order  
+    if fn is None:
+        workers = 1
+    else:
+        image = fn         
+    nrows = blockrows(outDataset.GetRasterBand(1),cols)
+    writer = BlockWriter(outDataset,nrows)
+    normalizer = Normalizer(image,pos,aa,bb,x0,y0,cols,rows,writer.nrows)
+    tiles = imapordered(normalizer,range(0,rows,writer.nrows),workers)
+    try:
+        for tile in tiles:
+            writer.write(tile)
+    finally:
+        tiles.close()
+    writer.close()
+    outDataset = None   
  
 def main():
     usage = '''
 Usage: 
 --------------------------------------------------------
 python %s  [-p "bandPositions"] [-d "spatialDimensions"] 
-[-t no-change prob threshold] imadFile [fullSceneFile]' 
+[-t no-change prob threshold] [-m max no-change pixels]
+[-j threads] [-v] imadFile [fullSceneFile]' 
 --------------------------------------------------------
 bandPositions and spatialDimensions are quoted lists, 
 e.g., -p [4,5,6] -d [0,0,400,400]
 -n stops graphics output
+-m no-change pixels are a uniform random sample of at
+   most this many (default 100000) of the pixels above
+   the threshold. The images are streamed in blocks, so
+   memory use does not grow with the scene size
+-j number of threads normalizing the output (default 4)
+-v write the normalized full scene as a VRT which applies
+   the gains and offsets on the fly (fullSceneFile_norm_all.vrt)
 
 SpatialDimensions MUST match those of imadFile
 spectral dimension of fullSceneFile, if present,
@@ -55,10 +252,13 @@ name the normalized full scene, if present:
 Note that, for ENVI format, ext is the empty string.
 -------------------------------------------------------'''%sys.argv[0]
 
-    options, args = getopt.getopt(sys.argv[1:],'hnp:d:t:')
+    options, args = getopt.getopt(sys.argv[1:],'hnp:d:t:m:j:v')
     pos = None
     dims = None
     ncpThresh = 0.95  
+    maxpixels = 100000
+    workers = 4
+    vrt = False
     fsfn = None  
     graphics = True        
     for option, value in options:
@@ -73,6 +273,12 @@ Note that, for ENVI format, ext is the empty string.
             dims = eval(value) 
         elif option == '-t':
             ncpThresh = eval(value)    
+        elif option == '-m':
+            maxpixels = eval(value)
+        elif option == '-j':
+            workers = eval(value)
+        elif option == '-v':
+            vrt = True
     if (len(args) != 1) and (len(args) != 2):
         print 'Incorrect number of arguments'
         print usage
@@ -83,6 +289,8 @@ Note that, for ENVI format, ext is the empty string.
         path = os.path.dirname(fsfn)
         basename = os.path.basename(fsfn)
         root, ext = os.path.splitext(basename)
+        if vrt:
+            ext = '.vrt'
         fsoutfn = path+'/'+root+'_norm_all'+ext
     path = os.path.dirname(imadfn)
     basename = os.path.basename(imadfn)
@@ -107,106 +315,72 @@ Note that, for ENVI format, ext is the empty string.
     if pos is None:
         pos = range(1,referenceDataset.RasterCount+1)      
     if dims is None:
-        x0 = 0; y0 = 0
+        dims = [0,0,cols,rows]
     else:
-        x0,y0,cols,rows = dims          
-    chisqr = imadDataset.GetRasterBand(imadbands).ReadAsArray(0,0,cols,rows).ravel()
-    ncp = 1 - stats.chi2.cdf(chisqr,[imadbands-1])
-    idx = where(ncp>ncpThresh)[0]
-    
-    m = len(idx)
-    
-    idx1 = random.permutation(m)
-    
-    idxall = idx[idx1]
-    
-    idxtrain = idxall[0:2*m//3]
-    idxtest = idxall[2*m//3:]
-    mtrain = len(idxtrain)
-    mtest = len(idxtest)
-    
+        cols,rows = dims[2:]
+# if target image is warped, assume it has same dimensions as dims        
+    if targetroot.find('_warp') != -1:
+        offset2 = (0,0)
+    else:
+        offset2 = None    
+    bands = len(pos)
+    start = time.time()           
+#  sample the no-change pixels from the chi-square band    
+    blocks = ((row,nrows,tile[:,0]) for row,nrows,tile in 
+        BlockReader([imadDataset.GetRasterBand(imadbands)],[(0,0)],cols,rows))
+    idx,count = nochange(blocks,imadbands-1,ncpThresh,maxpixels)
+    try:
+        aa,bb,R,Pt,Pf,XYtrain = radcal(referenceDataset,targetDataset,
+                                        idx,pos,dims,offset2)
+    except Exception as e:
+        print 'Error: %s  --Image could not be read'%e
+        sys.exit(1)
+    mtrain = XYtrain.shape[0]
+    mtest = len(idx) - mtrain
     
     print time.asctime() 
     print 'reference: '+referencefn
     print 'target   : '+targetfn   
     print 'no-change probability threshold: '+str(ncpThresh)
+    print 'no-change pixels found: %i'%count
     print 'no-change pixels for training: %i, for testing: %i' %(mtrain,mtest) 
-    start = time.time()           
-    driver = targetDataset.GetDriver()    
-    outDataset = driver.Create(outfn,cols,rows,len(pos),GDT_Float32)
-    projection = imadDataset.GetProjection()
-    geotransform = imadDataset.GetGeoTransform()
-    if geotransform is not None:
-        outDataset.SetGeoTransform(geotransform)
-    if projection is not None:
-        outDataset.SetProjection(projection)    
-    aa = []
-    bb = []  
     if graphics:
         plt.figure(1,(9,6))
     j = 1
-    bands = len(pos)
     for k in pos:
-        x = referenceDataset.GetRasterBand(k).ReadAsArray(x0,y0,cols,rows).astype(float).ravel()
-        y = targetDataset.GetRasterBand(k).ReadAsArray(x0,y0,cols,rows).astype(float).ravel()
-        b,a,R = orthoregress(y[idxtrain],x[idxtrain])
-        my = max(y[idxtrain])
+        a,b = aa[j-1],bb[j-1]
+        x = XYtrain[:,j-1]
+        y = XYtrain[:,bands+j-1]
+        my = max(y)
         if (j<7) and graphics:
             plt.subplot(2,3,j)
-            plt.plot(y[idxtrain],x[idxtrain],'.')
+            plt.plot(y,x,'.')
             plt.plot([0,my],[a,a+b*my])
             plt.title('Band %i'%k)
             if ((j<4) and (bands<4)) or j>3:
                 plt.xlabel('Target')
             if (j==1) or (j==4):
                 plt.ylabel('Reference')
-        aa.append(a)
-        bb.append(b)     
-        outBand = outDataset.GetRasterBand(j)       
-        _,Pt = stats.ttest_ind(x[idxtest],a+b*y[idxtest])
-        f = var(x[idxtest])/var(a+b*y[idxtest])  
-        if f < 1.0:
-            f = 1/f   
-        Pf = stats.f.sf(f,mtest-1,mtest-1)      
-        print 'band: %i  slope: %f  intercept: %f  corr: %f  P(t-test): %f  P(F-test): %f' %(k,b,a,R,Pt,Pf)       
-        outBand.WriteArray(resize(a+b*y,(rows,cols)),0,0) 
-        outBand.FlushCache()
+        print 'band: %i  slope: %f  intercept: %f  corr: %f  P(t-test): %f  P(F-test): %f' \
+                                  %(k,b,a,R[j-1],Pt[j-1],Pf[j-1])       
         j += 1
+#  normalize the target      
+    if offset2 is None:
+        tdims = dims
+    else:
+        tdims = list(offset2)+[cols,rows]
+    normalize(targetfn,outfn,aa,bb,pos,tdims,workers=workers)
     if graphics:
         plt.show() 
         plt.close()   
-    referenceDataset = None
-    targetDataset = None
-    outDataset = None
     print 'result written to: '+outfn 
     if fsfn is not None:
         print 'normalizing '+fsfn+'...'
-        fsDataset = gdal.Open(fsfn,GA_ReadOnly)
         try:
-            cols = fsDataset.RasterXSize
-            rows = fsDataset.RasterYSize    
+            normalize(fsfn,fsoutfn,aa,bb,pos,workers=workers,vrt=vrt)
         except Exception as e:
-            print 'Error %s  -- Image could not be read in' 
+            print 'Error %s  -- Image could not be read in'%e 
             sys.exit(1)   
-        driver = fsDataset.GetDriver()
-        outDataset = driver.Create(fsoutfn,cols,rows,len(pos),GDT_Float32)
-        projection = fsDataset.GetProjection()
-        geotransform = fsDataset.GetGeoTransform()
-        if geotransform is not None:
-            outDataset.SetGeoTransform(geotransform)
-        if projection is not None:
-            outDataset.SetProjection(projection) 
-        j = 1    
-        for k in pos:
-            inBand = fsDataset.GetRasterBand(k)
-            outBand = outDataset.GetRasterBand(j)
-            for i in range(rows):
-                y = inBand.ReadAsArray(0,i,cols,1)
-                outBand.WriteArray(aa[j-1]+bb[j-1]*y,0,i) 
-            outBand.FlushCache()  
-            j += 1     
-        outDataset = None   
-        fsDataset = None 
         print 'full result written to: '+fsoutfn   
     print 'elapsed time: %s'%str(time.time()-start)
     
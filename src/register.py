@@ -16,13 +16,80 @@
 #    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 #    GNU General Public License for more details.
 
-from auxil.auxil import similarity
+from auxil.auxil import similarity, similarityref
 import os, sys, getopt, time
 import numpy as np
 from osgeo import gdal
 import scipy.ndimage.interpolation as ndii
 from osgeo.gdalconst import GA_ReadOnly, GDT_Float32
   
+def register(image1,image2,warpband=1,dims=None,outfn=None,driver=None,
+             ref=None):
+    '''Register image2 to image1 (filenames or GDAL datasets) with
+       a similarity transform estimated from band warpband within
+       the spatial subset dims = [x0,y0,cols,rows] of image1. The
+       warped image2 is trimmed to dims and written to outfn with
+       the given driver (default that of image2), or held in a MEM
+       dataset if outfn is None. ref is an optional precomputed 
+       auxil.similarityref of the reference band.
+       Returns (dataset,(scale,angle,shift))'''
+    datasets = []
+    for image in (image1,image2):
+        if isinstance(image,basestring):
+            image = gdal.Open(image,GA_ReadOnly)
+            if image is None:
+                raise ValueError('Images could not be read')
+        datasets.append(image)
+    inDataset1,inDataset2 = datasets
+    cols1 = inDataset1.RasterXSize
+    rows1 = inDataset1.RasterYSize    
+    cols2 = inDataset2.RasterXSize
+    rows2 = inDataset2.RasterYSize    
+    bands2 = inDataset2.RasterCount   
+    if dims is None:
+        x0 = 0
+        y0 = 0
+    else:
+        x0,y0,cols1,rows1 = dims    
+    
+    if ref is None:
+        band = inDataset1.GetRasterBand(warpband)
+        refband = band.ReadAsArray(x0,y0,cols1,rows1).astype(np.float32)
+        ref = similarityref(refband)
+    band = inDataset2.GetRasterBand(warpband)
+    warpband = band.ReadAsArray(x0,y0,cols1,rows1).astype(np.float32)
+    
+#  similarity transform parameters for reference band number            
+    scale, angle, shift = similarity(None, warpband, ref)
+
+    if outfn is None:
+        driver = gdal.GetDriverByName('MEM')
+        outfn = ''
+    elif driver is None:
+        driver = inDataset2.GetDriver()
+    outDataset = driver.Create(outfn,cols1,rows1,bands2,GDT_Float32)
+    projection = inDataset1.GetProjection()
+    geotransform = inDataset1.GetGeoTransform()
+    if geotransform is not None:
+        gt = list(geotransform)
+        gt[0] = gt[0] + x0*gt[1]
+        gt[3] = gt[3] + y0*gt[5]
+        outDataset.SetGeoTransform(tuple(gt))
+    if projection is not None:
+        outDataset.SetProjection(projection) 
+
+#  warp 
+    for k in range(bands2):       
+        inband = inDataset2.GetRasterBand(k+1)      
+        outBand = outDataset.GetRasterBand(k+1)
+        bn1 = inband.ReadAsArray(0,0,cols2,rows2).astype(np.float32)
+        bn2 = ndii.zoom(bn1, 1.0 / scale)
+        bn2 = ndii.rotate(bn2, angle)
+        bn2 = ndii.shift(bn2, shift)       
+        outBand.WriteArray(bn2[y0:y0+rows1, x0:x0+cols1]) 
+        outBand.FlushCache() 
+    return (outDataset,(scale,angle,shift))
+  
 def main(): 
     usage = '''
 Usage:
@@ -82,56 +149,11 @@ dimensions of the reference image.
     basename2 = os.path.basename(fn2)
     root2, ext2 = os.path.splitext(basename2)
     outfn = path2 + '/' + root2 + '_warp' + ext2
-    inDataset1 = gdal.Open(fn1,GA_ReadOnly)     
-    inDataset2 = gdal.Open(fn2,GA_ReadOnly)
     try:
-        cols1 = inDataset1.RasterXSize
-        rows1 = inDataset1.RasterYSize    
-        cols2 = inDataset2.RasterXSize
-        rows2 = inDataset2.RasterYSize    
-        bands2 = inDataset2.RasterCount   
+        outDataset,_ = register(fn1,fn2,warpband,dims1,outfn)
     except Exception as e:
         print 'Error %s  --Image could not be read in'%e
         sys.exit(1)     
-    if dims1 is None:
-        x0 = 0
-        y0 = 0
-    else:
-        x0,y0,cols1,rows1 = dims1    
-    
-    band = inDataset1.GetRasterBand(warpband)
-    refband = band.ReadAsArray(x0,y0,cols1,rows1).astype(np.float32)
-    band = inDataset2.GetRasterBand(warpband)
-    warpband = band.ReadAsArray(x0,y0,cols1,rows1).astype(np.float32)
-    
-#  similarity transform parameters for reference band number            
-    scale, angle, shift = similarity(refband, warpband)
-
-    driver = inDataset2.GetDriver()
-    outDataset = driver.Create(outfn,cols1,rows1,bands2,GDT_Float32)
-    projection = inDataset1.GetProjection()
-    geotransform = inDataset1.GetGeoTransform()
-    if geotransform is not None:
-        gt = list(geotransform)
-        gt[0] = gt[0] + x0*gt[1]
-        gt[3] = gt[3] + y0*gt[5]
-        outDataset.SetGeoTransform(tuple(gt))
-    if projection is not None:
-        outDataset.SetProjection(projection) 
-
-#  warp 
-    for k in range(bands2):       
-        inband = inDataset2.GetRasterBand(k+1)      
-        outBand = outDataset.GetRasterBand(k+1)
-        bn1 = inband.ReadAsArray(0,0,cols2,rows2).astype(np.float32)
-        bn2 = ndii.zoom(bn1, 1.0 / scale)
-        bn2 = ndii.rotate(bn2, angle)
-        bn2 = ndii.shift(bn2, shift)       
-        outBand.WriteArray(bn2[y0:y0+rows1, x0:x0+cols1]) 
-        outBand.FlushCache() 
-
-    inDataset1 = None
-    inDataset2 = None
     outDataset = None    
     print 'Warped image written to: %s'%outfn
     print 'elapsed time: %s'%str(time.time()-start)
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+#******************************************************************************
+#  Name:     test_auxil.py
+#  Purpose:  tests for the bounded, ordered thread pool map
+#  Usage:
+#    cd src; python -m unittest discover tests
+import os, sys, time, threading, unittest
+sys.path.insert(0,os.path.join(os.path.dirname(__file__),'..'))
+from auxil.auxil import imapordered
+
+class TestImapordered(unittest.TestCase):
+
+    def setUp(self):
+        self.taken = []
+        self.lock = threading.Lock()
+
+    def items(self,n):
+        for i in range(n):
+            with self.lock:
+                self.taken.append(i)
+            yield i
+
+    def test_order(self):
+        def func(i):
+#          later items finish first
+            time.sleep(0.001*(20-i))
+            return i*i
+        results = list(imapordered(func,self.items(20),workers=4))
+        self.assertEqual(results,[i*i for i in range(20)])
+
+    def test_bounded(self):
+        results = imapordered(lambda i: i,self.items(100),workers=2,ahead=2)
+        for i,result in enumerate(results):
+            time.sleep(0.002)
+#          never more than ahead*workers items past the consumer
+            self.assertTrue(len(self.taken) <= i+1+4)
+        self.assertEqual(len(self.taken),100)
+
+    def test_close(self):
+        results = imapordered(lambda i: i,self.items(100),workers=2)
+        self.assertEqual(next(results),0)
+        results.close()
+        n = len(self.taken)
+        time.sleep(0.01)
+        self.assertEqual(len(self.taken),n)
+        self.assertTrue(n < 100)
+
+    def test_error(self):
+        def func(i):
+            if i == 5:
+                raise ValueError('bad item')
+            return i
+        def run():
+            for result in imapordered(func,self.items(100),workers=2):
+                pass
+        self.assertRaises(ValueError,run)
+        self.assertTrue(len(self.taken) < 100)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+#******************************************************************************
+#  Name:     test_dist.py
+#  Purpose:  tests that the auxil sdist installed by the Dockerfile
+#            is current, rebuild it with: python setup.py sdist
+#  Usage:
+#    cd src; python -m unittest discover tests
+import os, re, tarfile, unittest
+
+src = os.path.join(os.path.dirname(os.path.abspath(__file__)),'..')
+
+def version():
+    with open(os.path.join(src,'setup.py')) as f:
+        return re.search(r"version\s*=\s*'([^']*)'",f.read()).group(1)
+
+class TestDist(unittest.TestCase):
+
+    def setUp(self):
+        self.name = 'auxil-%s'%version()
+        self.fn = os.path.join(src,'dist',self.name+'.tar.gz')
+
+    def test_dockerfile(self):
+        with open(os.path.join(src,'Dockerfile')) as f:
+            dockerfile = f.read()
+        self.assertTrue('dist/%s.tar.gz'%self.name in dockerfile)
+        self.assertEqual(set(re.findall(r'auxil-[0-9.]*[0-9]',dockerfile)),
+                         set([self.name]))
+
+    def test_current(self):
+        self.assertTrue(os.path.exists(self.fn),
+                        '%s missing, run python setup.py sdist'%self.fn)
+        tar = tarfile.open(self.fn)
+        try:
+            packed = dict((m.name,m) for m in tar.getmembers())
+            modules = sorted(fn for fn in os.listdir(os.path.join(src,'auxil'))
+                                     if fn.endswith('.py'))
+            for fn in modules:
+                member = packed.get('%s/auxil/%s'%(self.name,fn))
+                self.assertTrue(member is not None,'%s not in sdist'%fn)
+                with open(os.path.join(src,'auxil',fn),'rb') as f:
+                    self.assertEqual(tar.extractfile(member).read(),f.read(),
+                                     '%s in sdist is stale'%fn)
+        finally:
+            tar.close()
+
+if __name__ == '__main__':
+    unittest.main()
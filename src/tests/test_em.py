@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+#******************************************************************************
+#  Name:     test_em.py
+#  Purpose:  tests for mini-batch EM against full EM
+#  Usage:
+#    cd src; python -m unittest discover tests
+import os, sys, unittest
+import numpy as np
+sys.path.insert(0,os.path.join(os.path.dirname(__file__),'..'))
+import em
+
+def mixture(rows,cols,seed=1):
+#  pixel vectors of a 3 cluster Gaussian mixture and initial 
+#  memberships leaning towards the true clusters, so that both
+#  methods start in the basin of the same optimum
+    np.random.seed(seed)
+    means = np.array([[0.0,0.0],[6.0,1.0],[1.0,7.0]])
+    labels = np.random.randint(0,3,rows*cols)
+    G = means[labels] + np.random.randn(rows*cols,2)
+    U = np.random.random((3,rows*cols))
+    U[labels,np.arange(rows*cols)] += 0.5
+    U /= np.sum(U,axis=0)
+    return (G,U,means,labels)
+
+class TestMinibatch(unittest.TestCase):
+
+    def setUp(self):
+        self.rows,self.cols = 60,60
+        self.G,self.U,self.means,self.labels = mixture(self.rows,self.cols)
+
+    def test_matches_full_em(self):
+        U1,Ms1,Cs1,Ps1,_ = em.em(self.G,self.U.copy(),0.0,0.0,self.rows,self.cols)
+        np.random.seed(2)
+        U2,Ms2,Cs2,Ps2,_ = em.em_minibatch(self.G,self.U.copy(),500)
+#      clusters are matched by their means        
+        d = np.sum((Ms1[:,np.newaxis,:]-Ms2[np.newaxis,:,:])**2,axis=2)
+        perm = np.argmin(d,axis=1)
+        self.assertEqual(sorted(perm),[0,1,2])
+        self.assertTrue(np.max(np.abs(Ms1-Ms2[perm])) < 0.2)
+        self.assertTrue(np.max(np.abs(Ps1-Ps2[perm])) < 0.05)
+        labels1 = np.argmax(U1,axis=0)
+        labels2 = np.argmax(U2[perm],axis=0)
+        self.assertTrue(np.mean(labels1 == labels2) > 0.97)
+
+    def test_spatial_term(self):
+        np.random.seed(2)
+        U1,Ms1,_,_,_ = em.em_minibatch(self.G,self.U.copy(),500)
+        np.random.seed(2)
+        U2,Ms2,_,_,_ = em.em_minibatch(self.G,self.U.copy(),500,
+                                       beta=0.5,rows=self.rows,cols=self.cols)
+        self.assertTrue(np.allclose(Ms1,Ms2))
+        self.assertTrue(np.allclose(np.sum(U2,axis=0),1.0))
+        self.assertFalse(np.allclose(U1,U2))
+
+if __name__ == '__main__':
+    unittest.main()
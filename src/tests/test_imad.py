@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+#******************************************************************************
+#  Name:     test_imad.py
+#  Purpose:  tests for the parallel row strips of IR-MAD
+#  Usage:
+#    cd src; python -m unittest discover tests
+import os, sys, shutil, tempfile, unittest
+import numpy as np
+sys.path.insert(0,os.path.join(os.path.dirname(__file__),'..'))
+from osgeo import gdal
+from osgeo.gdalconst import GDT_Float32
+import auxil.auxil as auxil
+import iMad
+
+def memimage(data):
+#  MEM dataset of a (bands,rows,cols) array
+    bands,rows,cols = data.shape
+    dataset = gdal.GetDriverByName('MEM').Create('',cols,rows,bands,GDT_Float32)
+    for k in range(bands):
+        dataset.GetRasterBand(k+1).WriteArray(data[k])
+    return dataset
+
+class TestRowStrips(unittest.TestCase):
+
+    def test_fewer_tiles_than_workers(self):
+#      a 90x70 image fits into a single tile
+        strips = auxil.rowstrips(70,3744,4)
+        self.assertEqual(len(strips),4)
+        self.assertEqual(strips[0][0],0)
+        self.assertEqual(strips[-1][1],70)
+        for (r0,r1),(s0,s1) in zip(strips[:-1],strips[1:]):
+            self.assertTrue(r0 < r1)
+            self.assertEqual(r1,s0)
+
+    def test_tile_alignment(self):
+        strips = auxil.rowstrips(100,10,3)
+        self.assertEqual(len(strips),3)
+        for r0,r1 in strips:
+            self.assertEqual(r0 % 10,0)
+
+class TestParallelImad(unittest.TestCase):
+
+    def test_small_image(self):
+        np.random.seed(1)
+        cols,rows,bands = 90,70,3
+        x = np.random.random((bands,rows,cols))*100 + 10
+        y = 0.8*x + np.random.random((bands,rows,cols))*20 + 5
+        strips = []
+        rowstrips = auxil.rowstrips
+        def spy(rows,nrows,n):
+            strips.extend(rowstrips(rows,nrows,n))
+            return strips
+        results = []
+        for workers in (1,3):
+            auxil.rowstrips = spy
+            try:
+                A,B,means1,means2,sigMADs,rhos,tiles = iMad.imad(
+                     memimage(x),memimage(y),niter=10,workers=workers)
+            finally:
+                auxil.rowstrips = rowstrips
+            chisqr = np.concatenate([c for row,nrows,mads,c in tiles])
+            results.append((rhos,chisqr))
+        self.assertEqual(len(strips),3)
+        self.assertTrue(np.allclose(results[0][0],results[1][0]))
+        self.assertTrue(np.allclose(results[0][1],results[1][1]))
+
+class TestRelease(unittest.TestCase):
+
+    def setUp(self):
+        self.scratch = tempfile.mkdtemp()
+        np.random.seed(1)
+        self.x = np.random.random((2,40,30))*100 + 1
+        self.y = self.x + np.random.random((2,40,30))*30
+
+    def tearDown(self):
+        shutil.rmtree(self.scratch)
+
+    def test_close_unexhausted(self):
+#      the image pair is spilled to a scratch file with budget=0
+        result = iMad.imad(memimage(self.x),memimage(self.y),budget=0,
+                           scratch=self.scratch)
+        self.assertEqual(len(os.listdir(self.scratch)),1)
+        result[-1].close()
+        self.assertEqual(os.listdir(self.scratch),[])
+
+    def test_failed_run(self):
+#      singular band set
+        self.x[1] = self.x[0]
+        for workers in (1,2):
+            self.assertRaises(np.linalg.LinAlgError,iMad.imad,
+                  memimage(self.x),memimage(self.y),budget=0,
+                  scratch=self.scratch,workers=workers)
+            self.assertEqual(os.listdir(self.scratch),[])
+
+if __name__ == '__main__':
+    unittest.main()